@@ -0,0 +1,112 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from epipolar import ComputeFundamentalBatch
+# importing epivalid puts the repository root on sys.path
+from epivalid import load_image
+from epipolar_line import detect_features, draw_lines_batch, epilines_batch
+
+# undistortion outputs of the worker process, one per side of a pair,
+# the overlays are drawn on copies
+_buffers = dict()
+
+
+def query_points(image, query='grid', num_points=64, feature_cache=None):
+    # (M, 2) pixel coordinates in the source image: a regular lattice of
+    # about num_points points, or num_points detected keypoints spread
+    # over the detector output
+    h, w = image.shape[:2]
+    if query == 'keypoints':
+        pts, _ = detect_features(image, feature_cache)
+        pts = np.asarray(pts, dtype=float)
+        if len(pts) > num_points:
+            pts = pts[np.linspace(0, len(pts) - 1, num_points).astype(int)]
+        return pts
+    side = max(1, int(round(np.sqrt(num_points))))
+    xs = (np.arange(side) + 0.5) * w / side
+    ys = (np.arange(side) + 0.5) * h / side
+    xx, yy = np.meshgrid(xs, ys)
+    return np.stack([xx.ravel(), yy.ravel()], axis=1)
+
+
+def render_pair(fmat, path_left, path_right, sensor_left, sensor_right, out_path,
+                query='grid', num_points=64, feature_cache=None, thumb_width=None):
+    # query points on the left image, their epilines on the right image,
+    # side by side. returns a thumb_width wide thumbnail if asked for
+    img_left = load_image(path_left, sensor_left, buffers=_buffers, slot='left')
+    img_right = load_image(path_right, sensor_right, buffers=_buffers, slot='right')
+    pts = query_points(img_left, query, num_points, feature_cache)
+    # x_left^T F x_right = 0, so the line of x_left in the right image is F^T x_left
+    lines = epilines_batch(pts, fmat, which_image=2)[0][0]
+    left = draw_lines_batch(img_left, None, pts, thickness=2)
+    right = draw_lines_batch(img_right, lines, None, thickness=2)
+    if left.shape[0] != right.shape[0]:
+        scale = left.shape[0] / right.shape[0]
+        right = cv2.resize(right, (int(round(right.shape[1] * scale)), left.shape[0]))
+    overlay = np.concatenate([left, right], axis=1)
+    if out_path is not None:
+        cv2.imwrite(out_path, overlay)
+    if thumb_width is None:
+        return None
+    thumb_height = int(round(overlay.shape[0] * thumb_width / overlay.shape[1]))
+    return cv2.resize(overlay, (thumb_width, thumb_height), interpolation=cv2.INTER_AREA)
+
+
+def _render_task(task):
+    args, kwargs = task
+    return render_pair(*args, **kwargs)
+
+
+def contact_sheet(thumbs, labels, columns=4):
+    # one page of labelled thumbnails, columns wide
+    h, w = thumbs[0].shape[:2]
+    rows = -(-len(thumbs) // columns)
+    page = np.full((rows * h, columns * w, 3), 255, dtype=np.uint8)
+    for k, (thumb, label) in enumerate(zip(thumbs, labels)):
+        r, c = divmod(k, columns)
+        tile = page[r * h:(r + 1) * h, c * w:(c + 1) * w]
+        thumb = thumb[:h, :w]
+        tile[:thumb.shape[0], :thumb.shape[1]] = thumb
+        cv2.putText(tile, label, (8, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 3)
+        cv2.putText(tile, label, (8, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 1)
+    return page
+
+
+def export_overlays(cameras, pairs, main_folder, out_dir, workers=None, query='grid',
+                    num_points=64, feature_cache=None, sheet=False, pair_images=True,
+                    thumb_width=640):
+    # renders every (left, right) pair in a process pool into
+    # out_dir/pair_<left>_<right>.jpg and/or out_dir/sheet_<page>.jpg
+    os.makedirs(out_dir, exist_ok=True)
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    fmats = ComputeFundamentalBatch(cameras, pairs)
+    tasks = []
+    for (left, right), fmat in zip(pairs, fmats):
+        cam_left, cam_right = cameras[int(left)], cameras[int(right)]
+        out_path = os.path.join(out_dir, 'pair_%d_%d.jpg' % (left, right)) if pair_images else None
+        tasks.append(((fmat,
+                       os.path.join(main_folder, "images", cam_left.image_path),
+                       os.path.join(main_folder, "images", cam_right.image_path),
+                       cam_left.sensor, cam_right.sensor, out_path),
+                      dict(query=query, num_points=num_points, feature_cache=feature_cache,
+                           thumb_width=thumb_width if sheet else None)))
+
+    # results come back in order, sheets are written as soon as a page is full
+    per_page = 24
+    thumbs, labels, page = [], [], 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for (left, right), thumb in zip(pairs, pool.map(_render_task, tasks,
+                                                        chunksize=max(1, len(tasks) // 64))):
+            print('OVERLAY', left, right)
+            if not sheet:
+                continue
+            thumbs.append(thumb)
+            labels.append('%d - %d' % (left, right))
+            if len(thumbs) == per_page:
+                cv2.imwrite(os.path.join(out_dir, 'sheet_%03d.jpg' % page), contact_sheet(thumbs, labels))
+                thumbs, labels, page = [], [], page + 1
+    if thumbs:
+        cv2.imwrite(os.path.join(out_dir, 'sheet_%03d.jpg' % page), contact_sheet(thumbs, labels))
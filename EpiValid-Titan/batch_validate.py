@@ -0,0 +1,80 @@
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from epipolar import ComputeFundamentalBatch, SampsonDistance, SymmetricEpipolarDistance
+# importing epivalid puts the repository root on sys.path
+from epivalid import load_image
+from epipolar_line import detect_features, match_descriptors
+
+
+# undistortion outputs of the worker process, one per side of a pair,
+# both images are done with before the next pair is loaded
+_buffers = dict()
+
+COLUMNS = ['left', 'right', 'left_image', 'right_image', 'matches',
+           'sampson_median', 'sampson_mean', 'sampson_p90',
+           'symmetric_median', 'symmetric_mean', 'symmetric_p90']
+
+
+def _stats(values):
+    if len(values) == 0:
+        return [np.nan] * 3
+    return [np.median(values), np.mean(values), np.percentile(values, 90)]
+
+
+def validate_pair(fmat, path_left, path_right, sensor_left, sensor_right,
+                  matcher='bf', feature_cache=None, reduction=1):
+    # features are matched on undistorted images, where F is valid.
+    # reduction 2, 4 or 8 matches on images decoded at reduced size,
+    # points are mapped back to full resolution pixels. the sub-pixel
+    # keypoints are scored, find_matches would round them to int
+    img_left = load_image(path_left, sensor_left, reduction, _buffers, 'left')
+    img_right = load_image(path_right, sensor_right, reduction, _buffers, 'right')
+    pts_left, des_left = detect_features(img_left, feature_cache)
+    pts_right, des_right = detect_features(img_right, feature_cache)
+    idx_left, idx_right = match_descriptors(des_left, des_right, matcher=matcher)
+    pts_left = (np.asarray(pts_left[idx_left], dtype=float).reshape(-1, 2) + 0.5) * reduction - 0.5
+    pts_right = (np.asarray(pts_right[idx_right], dtype=float).reshape(-1, 2) + 0.5) * reduction - 0.5
+    return ([len(pts_left)]
+            + _stats(SampsonDistance(fmat, pts_left, pts_right))
+            + _stats(SymmetricEpipolarDistance(fmat, pts_left, pts_right)))
+
+
+def _validate_task(task):
+    return validate_pair(*task)
+
+
+def validate_pairs(cameras, pairs, main_folder, workers=None, matcher='bf', feature_cache=None):
+    # one row per (left, right) pair, pairs are matched in a process pool,
+    # features are extracted once per image into feature_cache
+    if feature_cache is None:
+        feature_cache = os.path.join(main_folder, "features")
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    fmats = ComputeFundamentalBatch(cameras, pairs)
+    tasks = []
+    for (left, right), fmat in zip(pairs, fmats):
+        cam_left, cam_right = cameras[int(left)], cameras[int(right)]
+        tasks.append((fmat,
+                      os.path.join(main_folder, "images", cam_left.image_path),
+                      os.path.join(main_folder, "images", cam_right.image_path),
+                      cam_left.sensor, cam_right.sensor, matcher, feature_cache))
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(_validate_task, tasks, chunksize=max(1, len(tasks) // 64))
+        for (left, right), task, result in zip(pairs, tasks, results):
+            row = [int(left), int(right), os.path.basename(task[1]), os.path.basename(task[2])] + result
+            print('PAIR', *row[:5], 'sampson_median %.3f' % row[5])
+            rows.append(row)
+    return rows
+
+
+def write_table(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for row in rows:
+            writer.writerow(['%.4f' % v if isinstance(v, float) else v for v in row])
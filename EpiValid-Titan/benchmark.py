@@ -0,0 +1,379 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from scene import CameraArray
+from se3_vec import SE3VecToMat, SE3VecInv, SE3VecToMatBatch, SE3VecInvBatch
+from epipolar import ComputeFundamental, ComputeFundamentalBatch, SampsonDistance, \
+    GetExtrinsicMatrices, GetPinholeMatrix, GetPinholeMatrices
+from parse_whkrt import parse, parse_nerf, parse_nerf_chunks, parse_colmap
+# importing epivalid puts the repository root on sys.path
+from epivalid import undistort
+from epipolar_line import find_matches, clip_lines, epilines_batch
+
+SIZES = [10, 100, 1000, 10000, 100000]
+GROUPS = ['parse', 'se3', 'fundamental', 'epilines', 'undistort', 'matches']
+
+
+# synthetic data
+
+def synthetic_rig(num_cameras, num_points=256, radius=5.0, resolution=(1280, 720), seed=0):
+    # num_cameras cameras on a sphere of the given radius, all looking at
+    # points spread in the unit ball around the origin.
+    # returns a camera-to-world CameraArray and the (num_points, 3) points
+    rng = np.random.default_rng(seed)
+    # fibonacci sphere, upper half so no camera looks straight up or down
+    k = np.arange(num_cameras) + 0.5
+    z = 0.8 * k / num_cameras
+    phi = k * np.pi * (3 - np.sqrt(5))
+    r = np.sqrt(1 - z ** 2)
+    centres = radius * np.stack([r * np.cos(phi), r * np.sin(phi), z], axis=1)
+    centres += rng.normal(scale=0.05, size=centres.shape)
+
+    # opencv camera axes: z forward to the origin, x right, y down
+    forward = -centres / np.linalg.norm(centres, axis=1, keepdims=True)
+    right = np.cross(forward, [0, 0, 1])
+    right /= np.linalg.norm(right, axis=1, keepdims=True)
+    down = np.cross(forward, right)
+    rots = np.stack([right, down, forward], axis=2)
+
+    poses = np.concatenate([Rotation.from_matrix(rots).as_rotvec(), centres], axis=1)
+
+    width, height = resolution
+    focal = 0.8 * width
+    intrs = np.tile([focal, focal, 0.0, 0.0], (num_cameras, 1))
+    intrs += np.concatenate([rng.normal(scale=2, size=(num_cameras, 2)),
+                             rng.normal(scale=1, size=(num_cameras, 2))], axis=1)
+    dists = np.zeros((num_cameras, 5))
+    dists[:, :2] = rng.normal([-0.1, 0.02], [0.01, 0.002], size=(num_cameras, 2))
+    ress = np.tile(resolution, (num_cameras, 1))
+    image_paths = ['%06d.jpg' % i for i in range(num_cameras)]
+
+    points = rng.normal(size=(num_points, 3))
+    points /= np.maximum(1, np.linalg.norm(points, axis=1, keepdims=True))
+    cams = CameraArray(poses, intrs, dists, ress, image_paths, is_to_local=False)
+    return cams, points
+
+
+def project(cams: CameraArray, points):
+    # (N, P, 2) undistorted pixel coordinates of points in every camera
+    rots, transs = GetExtrinsicMatrices(cams)
+    pts_cam = points[None, :, :] @ rots.transpose(0, 2, 1) + transs[:, None, :]
+    pix = pts_cam @ GetPinholeMatrices(cams).transpose(0, 2, 1)
+    return pix[:, :, :2] / pix[:, :, 2:]
+
+
+def write_whkrt(folder, cams: CameraArray):
+    # calibration json with the txt tables it points to, as read by parse()
+    ress = cams.resolutions
+    intrs = cams.intrinsics
+    Ks = np.zeros((len(cams), 9))
+    Ks[:, 0], Ks[:, 4], Ks[:, 8] = intrs[:, 0], intrs[:, 1], 1
+    Ks[:, 2] = intrs[:, 2] + (ress[:, 0] - 1) / 2
+    Ks[:, 5] = intrs[:, 3] + (ress[:, 1] - 1) / 2
+    c2ws = SE3VecToMatBatch(cams.poses)[:, :3].reshape(-1, 12)
+    tables = dict(intrs=Ks, c2ws=c2ws, res=ress, dists=cams.distortions)
+    js = dict()
+    for name, table in tables.items():
+        js[name] = os.path.join(folder, name + '.txt')
+        np.savetxt(js[name], table, fmt='%d' if name == 'res' else '%.17g')
+    path_js = os.path.join(folder, 'calib.json')
+    with open(path_js, 'w') as f:
+        json.dump(js, f)
+    return path_js
+
+
+def write_nerf(folder, cams: CameraArray):
+    # transforms.json of a single sensor rig, as read by parse_nerf()
+    width, height = (int(v) for v in cams.resolutions[0])
+    fx, fy, cx, cy = cams.intrinsics[0]
+    k1, k2, p1, p2, k3 = cams.distortions[0]
+    mats = SE3VecToMatBatch(cams.poses)
+    mats[:, :3, 1:3] = -mats[:, :3, 1:3] # opengl axes
+    js = dict(w=width, h=height, fl_x=fx, fl_y=fy,
+              cx=cx + (width - 1) / 2, cy=cy + (height - 1) / 2,
+              K1=k1, K2=k2, K3=k3, P1=p1, P2=p2,
+              frames=[dict(file_path='images/' + path, transform_matrix=mat.tolist())
+                      for path, mat in zip(cams.image_paths, mats)])
+    path_js = os.path.join(folder, 'transforms.json')
+    with open(path_js, 'w') as f:
+        json.dump(js, f)
+    return path_js
+
+
+def write_colmap(folder, cams: CameraArray, points_per_image=16):
+    # sparse model folder with cameras.bin and images.bin, as read by
+    # parse_colmap(). one OPENCV camera per sensor id
+    model = os.path.join(folder, 'sparse')
+    os.makedirs(model, exist_ok=True)
+    sensor_ids, first = np.unique(cams.sensor_ids, return_index=True)
+    ress = cams.resolutions[first]
+    params = np.concatenate([cams.intrinsics[first], cams.distortions[first, :4]], axis=1)
+    params[:, 2:4] += ress / 2
+    record = np.dtype([('camera_id', '<i4'), ('model_id', '<i4'), ('width', '<u8'), ('height', '<u8'),
+                       ('params', '<f8', (8,))])
+    records = np.zeros(len(sensor_ids), dtype=record)
+    records['camera_id'], records['model_id'] = sensor_ids, 4
+    records['width'], records['height'] = ress[:, 0], ress[:, 1]
+    records['params'] = params
+    with open(os.path.join(model, 'cameras.bin'), 'wb') as f:
+        f.write(np.uint64(len(records)).tobytes() + records.tobytes())
+
+    vecs = cams.poses if cams.is_to_local else SE3VecInvBatch(cams.poses)
+    quats = Rotation.from_rotvec(vecs[:, :3]).as_quat()[:, [3, 0, 1, 2]]
+    head = np.dtype([('image_id', '<i4'), ('qvec', '<f8', 4), ('tvec', '<f8', 3), ('camera_id', '<i4')])
+    heads = np.zeros(len(cams), dtype=head)
+    heads['image_id'] = np.arange(len(cams)) + 1
+    heads['qvec'], heads['tvec'], heads['camera_id'] = quats, vecs[:, 3:], cams.sensor_ids
+    # x, y, point3D_id per observation, never read by the importer
+    points = np.zeros(points_per_image * 3).tobytes()
+    tail = np.uint64(points_per_image).tobytes() + points
+    with open(os.path.join(model, 'images.bin'), 'wb') as f:
+        f.write(np.uint64(len(cams)).tobytes())
+        f.write(b''.join(h.tobytes() + name.encode() + b'\0' + tail
+                         for h, name in zip(heads, cams.image_paths)))
+    return model
+
+
+def synthetic_image(resolution=(1280, 720), seed=0):
+    # blurred noise with some structure, textured enough for SIFT
+    width, height = resolution
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 256, (height // 8, width // 8), dtype=np.uint8)
+    img = cv2.resize(img, (width, height), interpolation=cv2.INTER_CUBIC)
+    for _ in range(64):
+        center = tuple(int(v) for v in rng.integers(0, (width, height)))
+        cv2.circle(img, center, int(rng.integers(4, 40)), int(rng.integers(0, 256)), -1)
+    return cv2.GaussianBlur(img, (3, 3), 0)
+
+
+def synthetic_pair(resolution=(1280, 720), seed=0):
+    # an image and a slightly rotated and scaled copy of it
+    img = synthetic_image(resolution, seed)
+    width, height = resolution
+    warp = cv2.getRotationMatrix2D((width / 2, height / 2), 5, 1.05)
+    return img, cv2.warpAffine(img, warp, (width, height), borderMode=cv2.BORDER_REFLECT)
+
+
+# measurement
+
+def measure(fn, repeat=3, trace=True):
+    # best wall time of repeat calls, and the peak of python and numpy
+    # allocations of one extra traced call (tracing slows python down,
+    # so it is not timed)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    peak = None
+    if trace:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peak
+
+
+class Report:
+    def __init__(self):
+        self.rows = []
+
+    def add(self, group, name, size, items, seconds, peak, unit='cam', **extra):
+        # size: cameras in the rig or pixels per image, throughput: items per second
+        row = dict(group=group, name=name, size=size, items=items, seconds=seconds,
+                   throughput=items / seconds if seconds > 0 else np.inf, unit=unit,
+                   peak=peak, **extra)
+        self.rows.append(row)
+        print('%-12s %-32s %8d %10.4f s %14.1f %-5s %10s %s' % (
+            group, name, size, seconds, row['throughput'], unit + '/s',
+            '-' if peak is None else '%.1f MB' % (peak / 2 ** 20),
+            ' '.join('%s=%.3g' % kv for kv in extra.items())))
+        sys.stdout.flush()
+
+    def save(self, path):
+        meta = dict(numpy=np.__version__, opencv=cv2.__version__, python=sys.version.split()[0],
+                    max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        with open(path, 'w') as f:
+            json.dump(dict(meta=meta, rows=self.rows), f, indent=1)
+
+    def compare(self, path):
+        # speedup of every row against a saved report, > 1 is faster now
+        with open(path, 'r') as f:
+            base = {(r['group'], r['name'], r['size']): r for r in json.load(f)['rows']}
+        print('\n%-12s %-32s %8s %10s %10s' % ('group', 'name', 'size', 'speedup', 'memory'))
+        for row in self.rows:
+            old = base.get((row['group'], row['name'], row['size']))
+            if old is None:
+                continue
+            memory = '-' if not (row['peak'] and old['peak']) else '%.2fx' % (row['peak'] / old['peak'])
+            print('%-12s %-32s %8d %9.2fx %10s' % (
+                row['group'], row['name'], row['size'], old['seconds'] / row['seconds'], memory))
+
+
+# benchmarks
+
+def bench_parse(report, size, cams, folder, repeat):
+    path_js = write_whkrt(folder, cams)
+    seconds, peak = measure(lambda: parse(path_js, use_cache=False), repeat)
+    report.add('parse', 'parse', size, size, seconds, peak)
+    parse(path_js)
+    seconds, peak = measure(lambda: parse(path_js), repeat)
+    report.add('parse', 'parse cached', size, size, seconds, peak)
+
+    path_js = write_nerf(folder, cams)
+    seconds, peak = measure(lambda: parse_nerf(path_js, use_cache=False), repeat)
+    report.add('parse', 'parse_nerf', size, size, seconds, peak)
+    # chunks dropped as they come, peak memory should follow the read block
+    # and chunk sizes rather than the file size
+    seconds, peak = measure(lambda: sum(len(chunk) for chunk in parse_nerf_chunks(path_js)), repeat)
+    report.add('parse', 'parse_nerf_chunks', size, size, seconds, peak,
+               file_mb=os.path.getsize(path_js) / 2 ** 20)
+    parse_nerf(path_js)
+    seconds, peak = measure(lambda: parse_nerf(path_js), repeat)
+    report.add('parse', 'parse_nerf cached', size, size, seconds, peak)
+
+    model = write_colmap(folder, cams)
+    seconds, peak = measure(lambda: parse_colmap(model, use_cache=False), repeat)
+    report.add('parse', 'parse_colmap', size, size, seconds, peak)
+
+
+def bench_se3(report, size, cams, scalar_limit, repeat):
+    vecs = cams.poses
+    scalar = vecs[:min(size, scalar_limit)]
+    seconds, peak = measure(lambda: [SE3VecToMat(v) for v in scalar], repeat)
+    report.add('se3', 'SE3VecToMat', size, len(scalar), seconds, peak)
+    seconds, peak = measure(lambda: [SE3VecInv(v) for v in scalar], repeat)
+    report.add('se3', 'SE3VecInv', size, len(scalar), seconds, peak)
+    seconds, peak = measure(lambda: SE3VecToMatBatch(vecs), repeat)
+    report.add('se3', 'SE3VecToMatBatch', size, size, seconds, peak)
+    seconds, peak = measure(lambda: SE3VecInvBatch(vecs), repeat)
+    report.add('se3', 'SE3VecInvBatch', size, size, seconds, peak)
+
+
+def bench_fundamental(report, size, cams, points, scalar_limit, repeat):
+    # each camera with the next one, the ring used by the viewer
+    pairs = np.stack([np.arange(size), (np.arange(size) + 1) % size], axis=1)
+    scalar = pairs[:min(size, scalar_limit)]
+    seconds, peak = measure(lambda: [ComputeFundamental(cams[int(i)], cams[int(j)])
+                                     for i, j in scalar], repeat)
+    report.add('fundamental', 'ComputeFundamental', size, len(scalar), seconds, peak, 'pair')
+    fmats = []
+    seconds, peak = measure(lambda: fmats.append(ComputeFundamentalBatch(cams, pairs)), repeat)
+    # the known points must satisfy the epipolar constraint
+    pix = project(cams[pairs[:64, 0]], points), project(cams[pairs[:64, 1]], points)
+    error = max(np.max(SampsonDistance(fmat, left, right))
+                for fmat, left, right in zip(fmats[0][:64], *pix))
+    report.add('fundamental', 'ComputeFundamentalBatch', size, size, seconds, peak, 'pair',
+               max_sampson=error)
+
+
+def bench_epilines(report, size, cams, points, scalar_limit, repeat):
+    # the points of camera 0 in up to scalar_limit other cameras, as the
+    # viewer does for a click in one view, with as many clicks as points
+    targets = np.arange(1, min(size, scalar_limit + 1))
+    if len(targets) == 0:
+        return
+    fmats = ComputeFundamentalBatch(cams, np.stack([np.zeros_like(targets), targets], axis=1))
+    pts = project(cams[[0]], points)[0]
+    width, height = cams.resolutions[0]
+    items = len(targets) * len(pts)
+
+    def per_target():
+        for fmat in fmats:
+            lines = cv2.computeCorrespondEpilines(pts.reshape(-1, 1, 2), 2, fmat).reshape(-1, 3)
+            clip_lines(lines, width, height)
+    seconds, peak = measure(per_target, repeat)
+    report.add('epilines', 'computeCorrespondEpilines', size, items, seconds, peak, 'line')
+    lines = []
+    seconds, peak = measure(lambda: lines.append(epilines_batch(pts, fmats, (width, height), 2)), repeat)
+    # the known points of each target camera lie on their lines
+    hom = np.concatenate([project(cams[targets], points), np.ones((len(targets), len(pts), 1))], axis=2)
+    error = np.max(np.abs(np.einsum('kmi,kmi->km', lines[0][0], hom)))
+    report.add('epilines', 'epilines_batch', size, items, seconds, peak, 'line', max_distance=error)
+
+
+def bench_undistort(report, resolutions, repeat):
+    cams, _ = synthetic_rig(1)
+    for width, height in resolutions:
+        sensor = CameraArray(cams.poses, cams.intrinsics * [width / 1280, width / 1280, 1, 1],
+                             cams.distortions, [[width, height]]).sensor(0)
+        img = synthetic_image((width, height))
+        dst = np.empty_like(img)
+        size = width * height
+        intr = GetPinholeMatrix(sensor)
+        dist = np.array([getattr(sensor.distortion, k) for k in ['k1', 'k2', 'p1', 'p2', 'k3']])
+        seconds, peak = measure(lambda: cv2.undistort(img, intr, dist), repeat)
+        report.add('undistort', 'cv2.undistort %dx%d' % (width, height), size, size, seconds, peak, 'px')
+        seconds, peak = measure(lambda: undistort(img, sensor, dst), repeat)
+        report.add('undistort', 'undistort %dx%d' % (width, height), size, size, seconds, peak, 'px')
+
+
+def bench_matches(report, resolutions, folder, repeat):
+    for width, height in resolutions:
+        img1, img2 = synthetic_pair((width, height))
+        size = width * height
+        for matcher in ['bf', 'flann', 'mutual']:
+            pts = []
+            seconds, peak = measure(lambda: pts.append(find_matches(img1, img2, matcher=matcher)), repeat)
+            report.add('matches', 'find_matches %s %dx%d' % (matcher, width, height), size, size,
+                       seconds, peak, 'px', matches=len(pts[0][0]))
+        cache_dir = os.path.join(folder, 'features')
+        find_matches(img1, img2, cache_dir=cache_dir)
+        seconds, peak = measure(lambda: find_matches(img1, img2, cache_dir=cache_dir), repeat)
+        report.add('matches', 'find_matches cached %dx%d' % (width, height), size, size, seconds, peak, 'px')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description='Throughput and peak memory of the calibration and matching hot paths '
+                    'on synthetic camera rigs')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='rig sizes, in cameras')
+    parser.add_argument('--only', nargs='+', choices=GROUPS, default=GROUPS)
+    parser.add_argument('--resolutions', nargs='+', default=['640x360', '1280x720', '1920x1080'],
+                        help='image sizes for undistort and find_matches')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs, the best one is reported')
+    parser.add_argument('--scalar-limit', type=int, default=10000,
+                        help='at most this many calls of the per-camera functions per size')
+    parser.add_argument('--save', metavar='JSON', help='write the results to JSON')
+    parser.add_argument('--compare', metavar='JSON', help='print speedups against a saved run')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    resolutions = [tuple(int(v) for v in r.split('x')) for r in args.resolutions]
+    report = Report()
+    folder = tempfile.mkdtemp(prefix='epivalid_bench_')
+    try:
+        for size in args.sizes:
+            cams, points = synthetic_rig(size)
+            if 'parse' in args.only:
+                bench_parse(report, size, cams, folder, args.repeat)
+            if 'se3' in args.only:
+                bench_se3(report, size, cams, args.scalar_limit, args.repeat)
+            if 'fundamental' in args.only:
+                bench_fundamental(report, size, cams, points, args.scalar_limit, args.repeat)
+            if 'epilines' in args.only:
+                bench_epilines(report, size, cams, points, args.scalar_limit, args.repeat)
+        if 'undistort' in args.only:
+            bench_undistort(report, resolutions, args.repeat)
+        if 'matches' in args.only:
+            bench_matches(report, resolutions, folder, args.repeat)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if args.save:
+        report.save(args.save)
+    if args.compare:
+        report.compare(args.compare)
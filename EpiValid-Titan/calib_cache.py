@@ -0,0 +1,73 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from scene import CameraArray
+
+
+_VERSION = 1
+_FIELDS = ['poses', 'intrinsics', 'distortions', 'resolutions', 'sensor_ids', 'image_paths']
+
+
+def _cache_key(sources):
+    # absolute path, size and mtime of every source file
+    key = []
+    for path in sources:
+        stat = os.stat(path)
+        key.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return {'version': _VERSION, 'sources': key}
+
+
+def _load(cache_dir, key):
+    try:
+        with open(os.path.join(cache_dir, 'key.json'), 'r') as f:
+            meta = json.load(f)
+        if meta['key'] != key:
+            return None
+        arrays = dict()
+        for name in _FIELDS:
+            path = os.path.join(cache_dir, name + '.npy')
+            # copy-on-write, pages are read lazily and the file never changes
+            arrays[name] = np.load(path, mmap_mode='c') if os.path.exists(path) else None
+    except (OSError, ValueError, KeyError):
+        return None
+    return CameraArray(arrays['poses'], arrays['intrinsics'], arrays['distortions'],
+                       arrays['resolutions'], arrays['image_paths'], arrays['sensor_ids'],
+                       meta['is_to_local'])
+
+
+def _save(cache_dir, key, cams: CameraArray):
+    parent = os.path.dirname(os.path.abspath(cache_dir))
+    try:
+        tmp_dir = tempfile.mkdtemp(prefix='.calib_cache_', dir=parent)
+    except OSError:
+        return
+    try:
+        for name in _FIELDS:
+            array = getattr(cams, name)
+            if array is not None:
+                np.save(os.path.join(tmp_dir, name + '.npy'), array)
+        with open(os.path.join(tmp_dir, 'key.json'), 'w') as f:
+            json.dump({'key': key, 'is_to_local': cams.is_to_local}, f)
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # read-only location or another process won the race,
+        # the cache is an optimization only
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def cached(path_js, sources, load) -> CameraArray:
+    # load() result is stored next to path_js in a directory of .npy files,
+    # and memory-mapped on later calls while no source file has changed
+    cache_dir = path_js + '.cache'
+    key = _cache_key(sources)
+    cams = _load(cache_dir, key)
+    if cams is None:
+        cams = load()
+        _save(cache_dir, key, cams)
+    return cams
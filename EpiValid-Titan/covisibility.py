@@ -0,0 +1,101 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+from epipolar import GetExtrinsicMatrices, GetPinholeMatrices
+
+
+def _resolutions(cameras):
+    if hasattr(cameras, 'resolutions'):
+        return np.asarray(cameras.resolutions, dtype=float)
+    return np.array([cam.sensor.resolution for cam in cameras], dtype=float)
+
+
+def _FrustumSamples(rots, transs, intrs, ress, depths, grid):
+    # homogeneous world points (N, 4, S) on a grid x grid pixel lattice
+    # at each depth
+    u = np.linspace(0, 1, grid)
+    uu, vv = np.meshgrid(u, u)
+    pix = np.stack([uu.ravel(), vv.ravel(), np.ones(grid * grid)], axis=1)
+    pix = pix[None, :, :] * np.concatenate([ress - 1, np.ones((len(ress), 1))], axis=1)[:, None, :]
+    rays = pix @ np.linalg.inv(intrs).transpose(0, 2, 1)
+    pts_cam = (rays[:, None, :, :] * depths[:, :, None, None]).reshape(len(rots), -1, 3)
+    # X_world = R^T (X_cam - t)
+    ret = np.ones((len(rots), 4, pts_cam.shape[1]), dtype=np.float32)
+    ret[:, :3, :] = (rots.transpose(0, 2, 1) @ (pts_cam - transs[:, None, :]).transpose(0, 2, 1))
+    return ret
+
+
+def _Inside(pix):
+    # pix (..., 3, S) in image coordinates scaled to [0, 1],
+    # inside when 0 <= x / z <= 1 and 0 <= y / z <= 1, z > 0
+    x, y, z = pix[..., 0, :], pix[..., 1, :], pix[..., 2, :]
+    return (np.minimum(x, y) >= 0) & (np.maximum(x, y) <= z) & (z > 0)
+
+
+def CovisibilityGraph(cameras, top_k=10, num_candidates=32, max_distance=np.inf,
+                      far=None, num_depths=4, grid=3, min_score=0.1, chunk=4096):
+    # sparse symmetric (N, N) graph, entry (i, j) is the overlap score of
+    # cameras i and j: the mean fraction of frustum samples of one camera
+    # seen by the other. candidates are the num_candidates nearest camera
+    # centres (KD-tree), each camera keeps its top_k partners.
+    # far: frustum depth, defaults to twice the median candidate distance
+    num = len(cameras)
+    rots, transs = GetExtrinsicMatrices(cameras)
+    intrs = GetPinholeMatrices(cameras)
+    ress = _resolutions(cameras)
+    centres = -np.einsum('nji,nj->ni', rots, transs)
+    # projection to pixel coordinates divided by (width - 1, height - 1)
+    scale = np.concatenate([1 / (ress - 1), np.ones((num, 1))], axis=1)
+    projs = scale[:, :, None] * (intrs @ np.concatenate([rots, transs[:, :, None]], axis=2))
+    projs = projs.astype(np.float32)
+
+    k = min(num_candidates + 1, num)
+    dists, nbrs = cKDTree(centres).query(centres, k=k, distance_upper_bound=max_distance)
+    dists, nbrs = dists.reshape(num, k)[:, 1:], nbrs.reshape(num, k)[:, 1:]
+    valid = nbrs < num
+    nbrs = np.where(valid, nbrs, 0)
+    k -= 1
+    if far is None:
+        far = 2 * np.median(dists[valid]) if valid.any() else 1.0
+    depths = np.broadcast_to(np.linspace(far / num_depths, far, num_depths), (num, num_depths))
+    samples = _FrustumSamples(rots, transs, intrs, ress, depths, grid)
+    num_samples = samples.shape[2]
+
+    # each camera against all of its candidates in one batched matmul
+    scores = np.zeros((num, k))
+    for start in range(0, num, chunk):
+        i = np.arange(start, min(start + chunk, num))
+        j = nbrs[i]
+        # samples of i in candidates j: (n, k * 3, 4) @ (n, 4, S)
+        pix = projs[j].reshape(len(i), k * 3, 4) @ samples[i]
+        i_in_j = _Inside(pix.reshape(len(i), k, 3, num_samples)).mean(axis=2)
+        # samples of candidates j in i: (n, 3, 4) @ (n, 4, k * S)
+        cand_samples = samples[j].transpose(0, 2, 1, 3).reshape(len(i), 4, k * num_samples)
+        pix = (projs[i] @ cand_samples).reshape(len(i), 3, k, num_samples).transpose(0, 2, 1, 3)
+        j_in_i = _Inside(pix).mean(axis=2)
+        scores[i] = (i_in_j + j_in_i) / 2
+
+    keep = valid & (scores >= min_score)
+    left = np.repeat(np.arange(num), k).reshape(num, k)[keep]
+    right, scores = nbrs[keep], scores[keep]
+    # top_k per camera, by descending score
+    order = np.lexsort((-scores, left))
+    left, right, scores = left[order], right[order], scores[order]
+    rank = np.arange(len(left)) - np.searchsorted(left, left)
+    keep = rank < top_k
+    left, right, scores = left[keep], right[keep], scores[keep]
+
+    # symmetric: an edge kept by either camera is kept for both
+    rows = np.concatenate([left, right])
+    cols = np.concatenate([right, left])
+    vals = np.concatenate([scores, scores])
+    _, first = np.unique(rows * num + cols, return_index=True)
+    return csr_matrix((vals[first], (rows[first], cols[first])), shape=(num, num))
+
+
+def CovisiblePairs(graph):
+    # (M, 2) pairs (i, j), i < j, of a covisibility graph
+    coo = graph.tocoo()
+    upper = coo.row < coo.col
+    return np.stack([coo.row[upper], coo.col[upper]], axis=1)
@@ -1,17 +1,6 @@
 import numpy as np
-from scene import Pose, Sensor, Camera
-from se3_vec import SE3VecToMat
-
-
-def _GetExtr(pose: Pose) -> Pose:
-    return pose if pose.is_to_local else pose.inverse()
-
-
-def _RT_Concate(rot, trans, shape=(3, 4)):
-    ret = np.eye(*shape)
-    ret[:3, :3] = rot
-    ret[:3, 3] = trans
-    return ret
+from scene import Sensor, Camera, CameraArray
+from se3_vec import SE3VecInvBatch, SE3VecToMatBatch
 
 
 def _CrossMat(vec):
@@ -34,23 +23,128 @@ def GetPinholeMatrix(sensor: Sensor):
 
 
 def ComputeFundamental(cam_left: Camera, cam_right: Camera):
-    extr_right = _GetExtr(cam_right.pose)
-    extr_left = _GetExtr(cam_left.pose)
-    w2left = _RT_Concate(
-        *SE3VecToMat(extr_left.transform.vector),
-        shape=(4, 4)
-    )
-    right2w = _RT_Concate(
-        *SE3VecToMat(extr_right.transform.inverse().vector),
-        shape=(4, 4)
-    )
-    right2left = w2left @ right2w
-
-    rot = right2left[:3, :3]
-    trans = right2left[:3, 3]
+    # per camera matrices are cached on the cameras
+    w2left = cam_left.extrinsic
+    w2right = cam_right.extrinsic
+
+    # right2left = w2left @ inv(w2right)
+    rot = w2left[:3, :3] @ w2right[:3, :3].T
+    trans = w2left[:3, 3] - rot @ w2right[:3, 3]
     trans_cross = _CrossMat(trans)
 
-    intr_right = GetPinholeMatrix(cam_right.sensor)
-    intr_left = GetPinholeMatrix(cam_left.sensor)
+    return cam_left.intrinsic_inverse.T @ trans_cross @ rot @ cam_right.intrinsic_inverse
+
+
+def GetExtrinsicMatrices(cameras):
+    # world-to-camera rotation (N, 3, 3) and translation (N, 3)
+    if not isinstance(cameras, CameraArray):
+        # cached on each camera
+        mats = np.stack([cam.extrinsic for cam in cameras])
+        return mats[:, :3, :3], mats[:, :3, 3]
+    vecs = cameras.poses if cameras.is_to_local else SE3VecInvBatch(cameras.poses)
+    mats = SE3VecToMatBatch(vecs)
+    return mats[:, :3, :3], mats[:, :3, 3]
+
+
+def _CrossMats(vecs):
+    ret = np.zeros((len(vecs), 3, 3))
+    x, y, z = vecs[:, 0], vecs[:, 1], vecs[:, 2]
+    ret[:, 0, 1], ret[:, 0, 2] = -z, y
+    ret[:, 1, 0], ret[:, 1, 2] = z, -x
+    ret[:, 2, 0], ret[:, 2, 1] = -y, x
+    return ret
+
+
+def GetPinholeMatrices(cameras):
+    if not isinstance(cameras, CameraArray):
+        return np.stack([cam.intrinsic for cam in cameras])
+    ret = np.zeros((len(cameras), 3, 3))
+    ret[:, 0, 0] = cameras.intrinsics[:, 0]
+    ret[:, 1, 1] = cameras.intrinsics[:, 1]
+    ret[:, :2, 2] = cameras.intrinsics[:, 2:] + (cameras.resolutions - 1) / 2
+    ret[:, 2, 2] = 1
+    return ret
+
+
+def GetPinholeInverses(cameras):
+    # (N, 3, 3) inverse pinhole matrices in closed form
+    if not isinstance(cameras, CameraArray):
+        return np.stack([cam.intrinsic_inverse for cam in cameras])
+    intrs = GetPinholeMatrices(cameras)
+    ret = np.zeros_like(intrs)
+    ret[:, 0, 0] = 1 / intrs[:, 0, 0]
+    ret[:, 1, 1] = 1 / intrs[:, 1, 1]
+    ret[:, :2, 2] = -intrs[:, :2, 2] / intrs[:, [0, 1], [0, 1]]
+    ret[:, 2, 2] = 1
+    return ret
+
+
+def AllPairs(num_cameras: int):
+    # (M, 2) index pairs (i, j) with i < j, row-major order
+    return np.stack(np.triu_indices(num_cameras, 1), axis=1)
+
+
+def ComputeFundamentalBatch(cameras, pairs=None):
+    # cameras: CameraArray or sequence of Camera, pairs: (M, 2) of (left, right) indices,
+    # all pairs i < j if omitted. returns (M, 3, 3) fundamental matrices,
+    # F[k] equals ComputeFundamental(cameras[i], cameras[j])
+    if not isinstance(cameras, CameraArray):
+        cameras = list(cameras)
+    pairs = AllPairs(len(cameras)) if pairs is None else np.asarray(pairs, dtype=int).reshape(-1, 2)
+    left, right = pairs[:, 0], pairs[:, 1]
+
+    rots, transs = GetExtrinsicMatrices(cameras)
+    intrs_inv = GetPinholeInverses(cameras)
+
+    # right2left = w2left @ inv(w2right)
+    rot = np.einsum('mij,mkj->mik', rots[left], rots[right])
+    trans = transs[left] - np.einsum('mij,mj->mi', rot, transs[right])
+    essential = _CrossMats(trans) @ rot
+
+    return np.einsum('mji,mjk,mkl->mil', intrs_inv[left], essential, intrs_inv[right])
+
+
+def _EpipolarResiduals(fmat, pts_left, pts_right):
+    # x_left^T F x_right, and the lines F x_right (left image),
+    # F^T x_left (right image) for (M, 2) pixel coordinates
+    hom_left = np.concatenate([pts_left, np.ones((len(pts_left), 1))], axis=1)
+    hom_right = np.concatenate([pts_right, np.ones((len(pts_right), 1))], axis=1)
+    lines_left = hom_right @ fmat.T
+    lines_right = hom_left @ fmat
+    residuals = np.einsum('mi,mi->m', hom_left, lines_left)
+    return residuals, lines_left, lines_right
 
-    return np.linalg.inv(intr_left).T @ trans_cross @ rot @ np.linalg.inv(intr_right)
+
+def SampsonDistance(fmat, pts_left, pts_right):
+    # first order geometric error in pixels, per correspondence
+    residuals, lines_left, lines_right = _EpipolarResiduals(fmat, pts_left, pts_right)
+    denom = np.sum(lines_left[:, :2] ** 2, axis=1) + np.sum(lines_right[:, :2] ** 2, axis=1)
+    return np.abs(residuals) / np.sqrt(denom)
+
+
+def SymmetricEpipolarDistance(fmat, pts_left, pts_right):
+    # mean of point-to-epiline distances in both images, in pixels
+    residuals, lines_left, lines_right = _EpipolarResiduals(fmat, pts_left, pts_right)
+    dist_left = np.abs(residuals) / np.linalg.norm(lines_left[:, :2], axis=1)
+    dist_right = np.abs(residuals) / np.linalg.norm(lines_right[:, :2], axis=1)
+    return (dist_left + dist_right) / 2
+
+
+def TriangulatePoint(projs, pts):
+    # linear (DLT) triangulation of one point seen in several views,
+    # projs (K, 3, 4) projection matrices, pts (K, 2) pixels. returns (3,)
+    projs = np.asarray(projs, dtype=float)
+    pts = np.asarray(pts, dtype=float)
+    rows = np.concatenate([
+        pts[:, 0:1] * projs[:, 2] - projs[:, 0],
+        pts[:, 1:2] * projs[:, 2] - projs[:, 1]])
+    _, _, vh = np.linalg.svd(rows)
+    return vh[-1, :3] / vh[-1, 3]
+
+
+def ProjectPoint(projs, point):
+    # (K, 2) pixels of a (3,) world point in every view, nan behind a camera
+    pix = projs @ np.append(point, 1.0)
+    ret = pix[:, :2] / pix[:, 2:]
+    ret[pix[:, 2] <= 0] = np.nan
+    return ret
@@ -1,39 +1,117 @@
-from functools import partial
+from functools import partial, lru_cache
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
 import argparse
+import traceback
 
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 
-from scene import Sensor
-from epipolar import ComputeFundamental, GetPinholeMatrix
+from scene import Sensor, Pinhole, Resolution
+from epipolar import ComputeFundamentalBatch, GetPinholeMatrix, AllPairs, \
+    TriangulatePoint, ProjectPoint
+import timing
+from frame_catalogue import FrameCatalogue
 
 import os
+import sys
 
+# epipolar_line lives in the repository root, modules importing
+# epivalid can import it as well
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from epipolar_line import epilines_batch
 
 
-def undistort(image: np.ndarray, sensor: Sensor):
+
+@lru_cache(maxsize=16)
+def _undistort_maps(intr: tuple, dist: tuple, size: tuple):
+    # same maps cv2.undistort builds internally on every call
+    intr_mat = np.array(intr).reshape(3, 3)
+    return cv2.initUndistortRectifyMap(
+        intr_mat, np.array(dist), None, intr_mat, size, cv2.CV_16SC2)
+
+
+def undistort(image: np.ndarray, sensor: Sensor, dst: Optional[np.ndarray] = None):
+    # dst: optional output buffer of image's shape and dtype, reused across calls
     if sensor.distortion is None:
         # no distortion, no need to undistort
         return image
-    intr_mat = GetPinholeMatrix(sensor)
-    dist = np.array([
+    dist = (
         sensor.distortion.k1,
         sensor.distortion.k2,
         sensor.distortion.p1,
         sensor.distortion.p2,
         sensor.distortion.k3
-    ])
-    ret = np.ones_like(image) * 255
-    return cv2.undistort(image, intr_mat, dist, dst=ret)
-
-
-class Epipolar_multi:
-    def __init__(self, cameras, photo_index, img_step, main_folder):
-        # In json: 3, 1, 2, 4, 5, 6, 7, 8
-        # 3, 4, 5, 6, 7, 8, 1, 2
-        # 0, 1, 2, 3, 4, 5, 6, 7
-        multi_co_list = [0, 4, 5, 6, 7, 8, 1, 2]
+    )
+    if not any(dist):
+        return image
+    intr = tuple(GetPinholeMatrix(sensor).ravel())
+    size = (image.shape[1], image.shape[0])
+    with timing.span('undistort'):
+        map1, map2 = _undistort_maps(intr, tuple(map(float, dist)), size)
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=dst)
+
+
+WINDOW_SIZE = (450, 650)
+# ms between redraws of the viewer, one display refresh at 60 Hz
+REFRESH_INTERVAL = 16
+
+_REDUCED_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def scale_sensor(sensor: Sensor, reduction: int, resolution: Resolution):
+    # sensor of an image downscaled by reduction, pixel centres aligned:
+    # x' = (x + 0.5) / reduction - 0.5, so the centre-relative cx, cy just scale
+    p = sensor.pinhole
+    pin = Pinhole(p.fx / reduction, p.fy / reduction, p.cx / reduction, p.cy / reduction)
+    return Sensor(resolution, pin, sensor.distortion)
+
+
+def display_reduction(resolution: Resolution, window_size=WINDOW_SIZE):
+    # coarsest decode level that still has a pixel per screen pixel
+    ratio = max(resolution[0] / window_size[0], resolution[1] / window_size[1])
+    return max([r for r in _REDUCED_FLAGS if r <= ratio], default=1)
+
+
+def load_image(image_path: str, sensor: Sensor, reduction: int = 1, buffers: Optional[dict] = None,
+               slot=0):
+    # reduction 2, 4 or 8 decodes directly at reduced size, and undistorts
+    # with the matching scaled intrinsics.
+    # buffers: undistortion outputs by slot, kept by the caller across calls.
+    # the image returned is overwritten by the next load into the same slot
+    with timing.span('imread'):
+        image = cv2.imread(image_path, _REDUCED_FLAGS[reduction])
+    if reduction != 1:
+        sensor = scale_sensor(sensor, reduction, Resolution(image.shape[1], image.shape[0]))
+    dst = None
+    if buffers is not None:
+        dst = buffers.get(slot)
+        if dst is None or dst.shape != image.shape or dst.dtype != image.dtype:
+            dst = buffers[slot] = np.empty_like(image)
+    return undistort(image, sensor, dst)
+
+
+# In json: 3, 1, 2, 4, 5, 6, 7, 8
+# 3, 4, 5, 6, 7, 8, 1, 2
+# 0, 1, 2, 3, 4, 5, 6, 7
+MULTI_CO_LIST = [0, 4, 5, 6, 7, 8, 1, 2]
+# camera ids in Titan file names, in MULTI_CO_LIST order
+RING_CAMERA_IDS = [3, 4, 5, 6, 7, 8, 1, 2]
+
+
+def select_ring(photo_index, img_step, offsets=None):
+    # camera indices of one ring group, in MULTI_CO_LIST order.
+    # offsets: frame offset of each ring camera, the table below if None,
+    # offset_search.py solves them per group
+    if offsets is None:
         # offsets = [0,0,0,0,0,0,0,0] # Debug
         # offsets = [0, 15, 25, 32, 50, 35, 30, 20]  # Group 0
         # offsets = [0, 2, 3, 5, 23, 16, 10, -1]  # Group 1
@@ -46,51 +124,129 @@ class Epipolar_multi:
         # offsets = [0, 15, 25, 32, 50, 35, 30, 20]  # Group 8
         # offsets = [0, 15, 25, 32, 50, 35, 30, 20]  # Group 9
         # offsets = [0, 15, 25, 32, 50, 35, 30, 20]  # Group 10
+    camera_indices = []
+    for i in range(len(MULTI_CO_LIST)):
+        x = MULTI_CO_LIST[i] if MULTI_CO_LIST[i] < 3 else MULTI_CO_LIST[i] - 1
+        camera_indices.append(x * img_step + photo_index + offsets[i])
+    return camera_indices
+
+
+def select_group(cameras, photo_index, img_step, catalogue: Optional[FrameCatalogue] = None,
+                 offsets=None):
+    # ring group synchronized by the timestamps in the file names
+    # (<ns timestamp>_<camera id>.jpg) around the photo_index-th frame of
+    # the first ring camera, the offset tables above for other datasets.
+    # offsets step each camera through its own frames in both cases
+    if catalogue is None:
+        catalogue = FrameCatalogue.from_cameras(cameras)
+    if not catalogue.has_cameras(RING_CAMERA_IDS):
+        return select_ring(photo_index, img_step, offsets)
+    return catalogue.group_at(photo_index, RING_CAMERA_IDS, offsets=offsets)
+
+
+def ring_pairs(num_cameras):
+    # each ring camera against its next neighbour
+    return [(i, (i + 1) % num_cameras) for i in range(num_cameras)]
+
+
+def _window_positions(num_views):
+    # the ring layout for 8 views, rows of 5 windows otherwise
+    if num_views <= 8:
+        return [[1495 , 30],
+                [1045 , 30],
+                [595 , 300],
+                [1045 , 710],
+                [1495 , 710],
+                [1945 , 710],
+                [2395 , 300],
+                [1945 , 30],]
+    # rows a window height plus its title bar apart, as in the ring layout
+    return [[145 + WINDOW_SIZE[0] * (k % 5), 30 + (WINDOW_SIZE[1] + 30) * (k // 5)] for k in range(num_views)]
+
+
+class Epipolar_multi:
+    def __init__(self, cameras, photo_index, img_step, main_folder, offsets=None,
+                 camera_indices=None, all_views=False, covisible=None):
+        # camera_indices: views to open instead of the ring group, in ring order.
+        # all_views: a click draws its epiline in every view, a click in a
+        # second view triangulates the point and marks it in every view.
+        # covisible: (K, K) bool, all_views epilines only go to views
+        # overlapping the clicked one, every view if None
+        multi_co_list = MULTI_CO_LIST
+        if camera_indices is None:
+            camera_indices = select_group(cameras, photo_index, img_step, offsets=offsets)
+            titles = ["camera_%02d" % m for m in multi_co_list]
+        else:
+            titles = ["camera_%d" % k for k in camera_indices]
+        num_views = len(camera_indices)
         cameras_list = []
-        image_list = []
-        for i in range(len(multi_co_list)):
-            x = multi_co_list[i] if multi_co_list[i] < 3 else multi_co_list[i] - 1
-            camera_index = x * img_step + photo_index + offsets[i]
+        image_paths = []
+        for camera_index in camera_indices:
             cameras_list.append(cameras[camera_index])
-            image_path = os.path.join(main_folder, "images", cameras[camera_index].image_path)
-            image_list.append(undistort(cv2.imread(image_path, cv2.IMREAD_GRAYSCALE), cameras[camera_index].sensor))
-        
-        fmat_list = []
-        for i in range(len(multi_co_list)):
+            image_paths.append(os.path.join(main_folder, "images", cameras[camera_index].image_path))
+
+        with timing.span('ComputeFundamental'):
+            fmat_list = list(ComputeFundamentalBatch(cameras_list, ring_pairs(num_views)))
+            # F of every ordered pair (i, j), the epilines of a point x in
+            # view i are the rows of x^T F[i]
+            views = np.arange(num_views)
+            self._fmats_all = ComputeFundamentalBatch(
+                cameras_list, np.stack(np.meshgrid(views, views, indexing='ij'), axis=-1).reshape(-1, 2)
+            ).reshape(num_views, num_views, 3, 3)
+        self._projections = np.stack([cam.projection for cam in cameras_list])
+        self._sizes = np.array([cam.sensor.resolution for cam in cameras_list])
+        self._pending = None
+        self._covisible = np.ones((num_views, num_views), dtype=bool) if covisible is None \
+            else np.asarray(covisible, dtype=bool)
+        # clicks are computed in order on one worker thread, their drawing
+        # operations wait in _done for the next _flush on the GUI thread
+        self._worker = ThreadPoolExecutor(max_workers=1)
+        self._done = deque()
 
-            camera_left = cameras_list[i]
-            camera_right = cameras_list[(i + 1) % len(multi_co_list)]
-            _fmat = ComputeFundamental(camera_left, camera_right)
-            fmat_list.append(_fmat)
-        
-        
         self.multi_co_list = multi_co_list
         self.cameras_list = cameras_list
         self.fmat_list = fmat_list
-        self.image_list = image_list
-
-        self._figs_list = []
-
-        window_position = [[1495 , 30],
-                           [1045 , 30],
-                           [595 , 300],
-                           [1045 , 710],
-                           [1495 , 710],
-                           [1945 , 710],
-                           [2395 , 300],
-                           [1945 , 30],]
-        
-        
+        self.image_list = [None] * num_views
 
-        for i in range(len(multi_co_list)):
+        self._figs_list = [None] * num_views
 
-            # draw_next = partial(self.draw_line, i, (i + 1) % len(multi_co_list), 2)
-            # draw_last = partial(self.draw_line, i, (i - 1) % len(multi_co_list), 1)
-            draw_lines = partial(self.draw_line, i, (i + 1) % len(multi_co_list), (i - 1) % len(multi_co_list))
-            _fig = ClickFigure(image_list[i], draw_lines,  window_position[i][0], window_position[i][1])
-            _fig.figure.canvas.manager.set_window_title("camera_%02d: %s" %(multi_co_list[i], cameras_list[i].image_path))
-            self._figs_list.append(_fig)
+        window_position = _window_positions(num_views)
+        
+        
 
+        # decode and undistort in worker threads (OpenCV releases the GIL),
+        # figures are created here on the GUI thread as each image arrives
+        # images are shown at a reduced pyramid level matching the window,
+        # full resolution is loaded by the figure when zooming in
+        with ThreadPoolExecutor(max_workers=min(num_views, 8)) as pool:
+            futures = dict()
+            for i in range(num_views):
+                sensor = cameras_list[i].sensor
+                reduction = display_reduction(sensor.resolution)
+                futures[pool.submit(load_image, image_paths[i], sensor, reduction)] = i
+            for future in as_completed(futures):
+                i = futures[future]
+                self.image_list[i] = future.result()
+                sensor = cameras_list[i].sensor
+
+                # draw_next = partial(self.draw_line, i, (i + 1) % len(multi_co_list), 2)
+                # draw_last = partial(self.draw_line, i, (i - 1) % len(multi_co_list), 1)
+                if all_views:
+                    draw_lines = partial(self.click, partial(self.propagate, i))
+                else:
+                    draw_lines = partial(self.click, partial(self.draw_line, i, (i + 1) % num_views,
+                                                             (i - 1) % num_views))
+                _fig = ClickFigure(self.image_list[i], draw_lines,  window_position[i][0], window_position[i][1],
+                                   full_size=sensor.resolution,
+                                   load_full=partial(load_image, image_paths[i], sensor))
+                _fig.figure.canvas.manager.set_window_title("%s: %s" %(titles[i], cameras_list[i].image_path))
+                self._figs_list[i] = _fig
+                _fig.figure.show()
+                _fig.figure.canvas.flush_events()
+
+        self._timer = self._figs_list[0].figure.canvas.new_timer(interval=REFRESH_INTERVAL)
+        self._timer.add_callback(self._flush)
+        self._timer.start()
 
         # i = 0
         # draw_next = partial(self.draw_line, i, (i + 1) % len(multi_co_list), 2)
@@ -106,6 +262,64 @@ class Epipolar_multi:
         # _fig_2.figure.canvas.manager.set_window_title("camera_%02d" %(multi_co_list[i]))
         # self._figs_list.append(_fig_2)
 
+    def click(self, handler, x, y):
+        # GUI thread: queue the click and return at once
+        start = timing.now()
+        self._worker.submit(self._compute, handler, x, y, start).add_done_callback(_report_error)
+
+    def _compute(self, handler, x, y, start):
+        # worker thread: handler returns (view, ClickFigure method, args)
+        # drawing operations, figures are only touched by _flush
+        self._done.append((start, handler(x, y)))
+
+    def _flush(self):
+        # GUI thread, every REFRESH_INTERVAL: apply the operations of all
+        # clicks computed since the last call, then update each figure once
+        dirty = set()
+        starts = []
+        while self._done:
+            start, ops = self._done.popleft()
+            for i, name, args in ops:
+                # views may still be loading
+                fig = self._figs_list[i]
+                if fig is not None:
+                    getattr(fig, name)(*args)
+                    dirty.add(i)
+            starts.append(start)
+        for i in sorted(dirty):
+            self._figs_list[i].update()
+        for start in starts:
+            timing.latency('click_to_render', start)
+
+    def propagate(self, curr_index, x, y):
+        print('PICK', curr_index, x, y)
+        with timing.span('epilines'):
+            # one product for all views, F[i, j]^T x, clipped to each view
+            _, segments, valid = epilines_batch([(x, y)], self._fmats_all[curr_index], self._sizes,
+                                                which_image=2)
+
+        point = None
+        if self._pending is not None and self._pending[0] != curr_index:
+            last_index, last_x, last_y = self._pending
+            with timing.span('triangulate'):
+                point = TriangulatePoint(self._projections[[last_index, curr_index]],
+                                         [[last_x, last_y], [x, y]])
+                pixels = ProjectPoint(self._projections, point)
+            print('POINT', point)
+            self._pending = None
+        else:
+            self._pending = (curr_index, x, y)
+
+        ops = []
+        for i in range(len(self._figs_list)):
+            if i == curr_index:
+                ops.append((i, 'mark', (x, y)))
+            elif valid[i, 0] and self._covisible[curr_index, i]:
+                ops.append((i, 'drawline', (segments[i, 0],)))
+            if point is not None and np.all(np.isfinite(pixels[i])):
+                ops.append((i, 'point', tuple(pixels[i])))
+        return ops
+
     def draw_line(self, curr_index, next_index, last_index, x, y):
         print('PICK', curr_index, next_index, last_index, x, y)
         
@@ -113,46 +327,80 @@ class Epipolar_multi:
         # lines = cv2.computeCorrespondEpilines(pts, cv_index, self.fmat_list[int(curr_index)])
         # line = lines[0][0]
 
-        lines_next = cv2.computeCorrespondEpilines(pts, 2, self.fmat_list[int(curr_index)])
-        line_next = lines_next[0][0]
-        lines_last = cv2.computeCorrespondEpilines(pts, 1, self.fmat_list[int(last_index)])
-        line_last = lines_last[0][0]
+        with timing.span('epilines'):
+            # F^T x in the next view, F x in the last view, as one batch
+            fmats = np.stack([self.fmat_list[int(curr_index)], self.fmat_list[int(last_index)].T])
+            lines, segments, valid = epilines_batch(pts, fmats, self._sizes[[next_index, last_index]],
+                                                    which_image=2)
+            line_next, line_last = lines[:, 0]
 
         print('line_next', line_next)
         print('line_last', line_last)
-        curr = self._figs_list[int(curr_index)]
-        curr.axis.scatter(x, y, marker='x')
-
-        nextt = self._figs_list[int(next_index)]
-        nextt.drawline(line_next)
-        lastt = self._figs_list[int(last_index)]
-        lastt.drawline(line_last)
+        ops = [(int(curr_index), 'mark', (x, y))]
+        if valid[0, 0]:
+            ops.append((int(next_index), 'drawline', (segments[0, 0],)))
+        if valid[1, 0]:
+            ops.append((int(last_index), 'drawline', (segments[1, 0],)))
         # target = self._figs_list[int(target_index)]
         # target.drawline(line)
-
-        curr.update()
-        nextt.update()
-        lastt.update()
         # target.update()
         # compute epipolar line from index and XY
         # CAVEAT
         # index???
         # cvindex = 1 + int(not index)
-        
+        return ops
+
+
+def _report_error(future):
+    # exceptions on the worker thread are otherwise lost
+    error = future.exception()
+    if error is not None:
+        traceback.print_exception(type(error), error, error.__traceback__)
+
 
 class ClickFigure:
-    def __init__(self, image: np.ndarray, pick_handler, *args):
+    def __init__(self, image: np.ndarray, pick_handler, *args,
+                 full_size: Optional[Resolution] = None, load_full=None,
+                 blit: bool = True, max_artists: int = 64):
+        # image may be a reduced display level of a full_size image,
+        # axis coordinates are always full resolution pixels.
+        # load_full() returns the full resolution image on zoom.
+        # blit: lines and marks are drawn over a cached background,
+        # at most the latest max_artists of each are kept
         self._img = image
-        self._width = image.shape[1]
-        self._height = image.shape[0]
+        self._width, self._height = (image.shape[1], image.shape[0]) if full_size is None else full_size
+        self._load_full = load_full
         self._fig = plt.figure()
         self._ax = self._fig.add_subplot(1, 1, 1)
 
         manager = plt.get_current_fig_manager()
-        manager.window.setGeometry(args[0], args[1], 450, 650)
+        manager.window.setGeometry(args[0], args[1], *WINDOW_SIZE)
 
-        self._ax.imshow(self._img, cmap='gray', vmin=0, vmax=255)
+        extent = (-0.5, self._width - 0.5, self._height - 0.5, -0.5)
+        self._im = self._ax.imshow(self._img, cmap='gray', vmin=0, vmax=255, extent=extent)
+        self._ax.set_xlim(0, self._width)
+        self._ax.set_ylim(self._height, 0)
         self._pick= pick_handler
+        self._ax.callbacks.connect('xlim_changed', self._onzoom)
+
+        self._blit = blit and self._fig.canvas.supports_blit
+        self._background = None
+        self._max_artists = max_artists
+        self._colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+        # per kind ('-' lines, 'x' clicks, 'o' reprojected points) a ring
+        # buffer and one artist whatever the number of items, plus one
+        # artist for the items added since the last update
+        self._buffers = {'-': np.zeros((max_artists, 2, 2)),
+                         'x': np.zeros((max_artists, 2)),
+                         'o': np.zeros((max_artists, 2))}
+        self._counts = {kind: 0 for kind in self._buffers}
+        self._artists = self._new_artists(self._blit)
+        self._fresh_artists = self._new_artists(True)
+        self._fresh = {kind: [] for kind in self._buffers}
+        self._erase = False
+        # kinds whose full artist lags its buffer, synced before full draws
+        self._stale = set()
+        self._fig.canvas.mpl_connect('draw_event', self._ondraw)
 
         #self._fig.canvas.mpl_connect('motion_notify_event', self._onmove) #debug
        # self._fig.canvas.mpl_connect('key_press_event', self.on_key_press)
@@ -163,16 +411,98 @@ class ClickFigure:
         self.update()
 
     def update(self):
-        self._fig.canvas.draw()
-
-    def drawline(self, coeff):
-        a, b, c = coeff
-
-        def y(x):
-            return -(a * x + c) / b
-        self._ax.plot([0, self._width], [y(0), y(self._width)])
-        self._ax.set_xlim(0, self._width)
-        self._ax.set_ylim(self._height, 0)
+        canvas = self._fig.canvas
+        if not self._blit or self._background is None:
+            # full draw, caches the background through _ondraw
+            self._sync()
+            with timing.span('canvas.draw'):
+                canvas.draw()
+            self._clear_fresh()
+            return
+        with timing.span('canvas.blit'):
+            if self._erase:
+                # an old item was overwritten, redraw all from the background
+                canvas.restore_region(self._background)
+                self._draw_artists(self._artists)
+            else:
+                # only new items, drawn over what is on the canvas
+                self._draw_artists(self._fresh_artists, self._fresh)
+            self._clear_fresh()
+            canvas.blit(self._fig.bbox)
+            canvas.flush_events()
+
+    def _ondraw(self, event):
+        if self._blit:
+            self._background = self._fig.canvas.copy_from_bbox(self._fig.bbox)
+            self._draw_artists(self._artists)
+            self._clear_fresh()
+
+    def _new_artists(self, animated):
+        lines = LineCollection([], animated=animated)
+        self._ax.add_collection(lines, autolim=False)
+        return {'-': lines,
+                'x': self._ax.scatter([], [], marker='x', animated=animated),
+                'o': self._ax.scatter([], [], marker='o', facecolors='none', s=80, animated=animated)}
+
+    @staticmethod
+    def _set_items(artist, kind, items, colors):
+        if kind == '-':
+            artist.set_segments(items)
+        else:
+            artist.set_offsets(items)
+        if kind == 'o':
+            artist.set_edgecolor(colors)
+        else:
+            artist.set_color(colors)
+
+    def _sync(self):
+        for kind in self._stale:
+            num = self._counts[kind]
+            colors = [self._colors[k % len(self._colors)] for k in range(num)]
+            self._set_items(self._artists[kind], kind, self._buffers[kind][:num], colors)
+        self._stale.clear()
+
+    def _draw_artists(self, artists, fresh=None):
+        if fresh is None:
+            self._sync()
+        for kind, artist in artists.items():
+            if fresh is not None:
+                if not fresh[kind]:
+                    continue
+                items, colors = zip(*fresh[kind])
+                self._set_items(artist, kind, np.array(items), list(colors))
+            self._fig.draw_artist(artist)
+
+    def _clear_fresh(self):
+        for items in self._fresh.values():
+            items.clear()
+        self._erase = False
+
+    def _add(self, kind, item):
+        # once full, the older half is dropped at once, so the full redraw
+        # erasing needs happens once every max_artists / 2 items
+        buffer = self._buffers[kind]
+        num = self._counts[kind]
+        if num == self._max_artists:
+            keep = self._max_artists // 2
+            buffer[:keep] = buffer[num - keep:num]
+            num = keep
+            self._erase = True
+        buffer[num] = item
+        self._counts[kind] = num + 1
+        self._stale.add(kind)
+        self._fresh[kind].append((item, self._colors[num % len(self._colors)]))
+
+    def mark(self, x, y):
+        self._add('x', (x, y))
+
+    def point(self, x, y):
+        # reprojected 3D point
+        self._add('o', (x, y))
+
+    def drawline(self, segment):
+        # ((x0, y0), (x1, y1)) end points, already clipped to the image
+        self._add('-', segment)
 
     @property
     def axis(self):
@@ -182,12 +512,27 @@ class ClickFigure:
     def figure(self):
         return self._fig
 
+    def _onzoom(self, ax):
+        # switch to full resolution once the view shows fewer
+        # image pixels than screen pixels
+        if self._load_full is None or self._img.shape[1] == self._width:
+            return
+        x0, x1 = ax.get_xlim()
+        shown = abs(x1 - x0) * self._img.shape[1] / self._width
+        if shown < ax.bbox.width:
+            self._img = self._load_full()
+            self._load_full = None
+            self._im.set_data(self._img)
+
     def _onclick(self, event):
         # callback on double click only
         if event.dblclick != 0:
             x = event.xdata
             y = event.ydata
             # print(id(self), x, y)
+            # outside the axes
+            if x is None:
+                return
             self._pick(x, y)
 
     # def _onmove(self):
@@ -201,27 +546,135 @@ class ClickFigure:
 def _parse_args():
     parser = argparse.ArgumentParser(
         description='Interactive epipolar line drawer')
-    parser.add_argument('cameras_json', help='path to cameras json')
-    parser.add_argument('camera_index', type=int, help='camera index in the group')
-    parser.add_argument('img_step', type=int, help='right camera index')
+    parser.add_argument('cameras_json',
+                        help='path to cameras json, or a COLMAP model folder with cameras.bin and images.bin')
+    parser.add_argument('camera_index', type=int,
+                        help='camera index in the group, the frame number of the first ring camera '
+                             'for timestamp-named captures')
+    parser.add_argument('img_step', type=int,
+                        help='right camera index, unused for timestamp-named captures')
+    parser.add_argument('--headless', action='store_true',
+                        help='validate pairs with feature matches instead of opening windows')
+    parser.add_argument('--pairs', choices=['ring', 'all', 'covisible'], default='ring',
+                        help='headless pair list: ring of the selected group, all camera pairs, '
+                             'or overlapping pairs from the covisibility graph')
+    parser.add_argument('--top-k', type=int, default=10,
+                        help='covisible partners kept per camera, and views opened with --covisible')
+    parser.add_argument('--pairs-file', help='headless pair list from a text file, one "i j" per line')
+    parser.add_argument('--output', default='epivalid.csv', help='headless result table')
+    parser.add_argument('--workers', type=int, default=None, help='headless worker processes')
+    parser.add_argument('--matcher', choices=['bf', 'flann', 'mutual'], default='bf',
+                        help='headless descriptor matcher')
+    parser.add_argument('--feature-cache', default=None,
+                        help='headless feature store, default DATASET/features')
+    parser.add_argument('--export', metavar='DIR',
+                        help='render epiline overlays of the pair list into DIR instead of validating')
+    parser.add_argument('--query', choices=['grid', 'keypoints'], default='grid',
+                        help='export query points on the left image')
+    parser.add_argument('--num-points', type=int, default=64, help='export query points per pair')
+    parser.add_argument('--sheet', action='store_true', help='export tiled contact sheets as well')
+    parser.add_argument('--all-views', action='store_true',
+                        help='draw epilines in every view, a click in a second view triangulates the point')
+    parser.add_argument('--views', type=int, nargs='+',
+                        help='camera indices to open instead of the ring group')
+    parser.add_argument('--covisible', action='store_true',
+                        help='open camera_index, as a camera index, and its --top-k covisible partners, '
+                             'epilines go to overlapping views only')
+    parser.add_argument('--offsets', metavar='JSON',
+                        help='ring offsets solved by offset_search.py, the group nearest camera_index is used')
+    parser.add_argument('--profile', action='store_true',
+                        help='time imread, undistort, epipolar geometry and drawing, print a summary at exit')
+    parser.add_argument('--trace', metavar='JSON',
+                        help='with --profile, also write a Chrome trace (chrome://tracing, Perfetto)')
 
     return parser.parse_args()
 
 
-def _load_nerf_cameras(path_json: str):
-    from parse_whkrt import parse_nerf
-    return parse_nerf(path_json)
+def _ring_offsets(args):
+    if args.offsets is None:
+        return None
+    from offset_search import read_offsets, group_offsets
+    return group_offsets(read_offsets(args.offsets), args.camera_index)
+
+
+def _covisible_views(cameras, camera_index, top_k):
+    # camera_index and its partners in the covisibility graph by descending
+    # overlap, and the (K, K) overlap mask of these views
+    from covisibility import CovisibilityGraph
+    graph = CovisibilityGraph(cameras, top_k=top_k).tocsr()
+    row = graph.getrow(camera_index)
+    partners = row.indices[np.argsort(-row.data, kind='stable')][:top_k]
+    views = [camera_index] + [int(j) for j in partners]
+    covisible = graph[views][:, views].toarray() > 0
+    np.fill_diagonal(covisible, True)
+    return views, covisible
+
+
+def _select_pairs(args, cameras):
+    if args.pairs_file is not None:
+        return np.loadtxt(args.pairs_file, dtype=int).reshape(-1, 2)
+    if args.pairs == 'all':
+        return AllPairs(len(cameras))
+    if args.pairs == 'covisible':
+        from covisibility import CovisibilityGraph, CovisiblePairs
+        return CovisiblePairs(CovisibilityGraph(cameras, top_k=args.top_k))
+    ring = select_group(cameras, args.camera_index, args.img_step, offsets=_ring_offsets(args))
+    return [(ring[i], ring[j]) for i, j in ring_pairs(len(ring))]
+
+
+def _load_cameras(path: str):
+    # transforms.json, or a COLMAP sparse model folder
+    from parse_whkrt import parse_nerf, parse_colmap
+    if os.path.isdir(path):
+        return parse_colmap(path)
+    return parse_nerf(path)
+
+
+def _main_folder(path: str):
+    # the dataset folder holding images/: next to transforms.json, or
+    # above a COLMAP model such as DATASET/sparse/0
+    if not os.path.isdir(path):
+        return os.path.dirname(path)
+    folder = os.path.abspath(path)
+    while not os.path.isdir(os.path.join(folder, "images")):
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return os.path.dirname(path)
+        folder = parent
+    return folder
 
 
 
 if __name__ == "__main__":
     args = _parse_args()
-
-    cameras = _load_nerf_cameras(args.cameras_json)
-
-    epi = Epipolar_multi(cameras, args.camera_index, args.img_step, os.path.dirname(args.cameras_json))
-    
-    plt.show()
+    if args.profile:
+        timing.enable(trace_path=args.trace)
+
+    cameras = _load_cameras(args.cameras_json)
+    main_folder = _main_folder(args.cameras_json)
+
+    if args.export is not None:
+        from batch_overlay import export_overlays
+        export_overlays(cameras, _select_pairs(args, cameras), main_folder, args.export,
+                        args.workers, args.query, args.num_points, args.feature_cache,
+                        sheet=args.sheet)
+    elif args.headless:
+        from batch_validate import validate_pairs, write_table
+        rows = validate_pairs(cameras, _select_pairs(args, cameras), main_folder, args.workers,
+                              args.matcher, args.feature_cache)
+        write_table(args.output, rows)
+    elif args.covisible:
+        views, covisible = _covisible_views(cameras, args.camera_index, args.top_k)
+        print('VIEWS', views)
+        epi = Epipolar_multi(cameras, args.camera_index, args.img_step, main_folder,
+                             camera_indices=views, all_views=True, covisible=covisible)
+
+        plt.show()
+    else:
+        epi = Epipolar_multi(cameras, args.camera_index, args.img_step, main_folder,
+                             _ring_offsets(args), args.views, args.all_views)
+
+        plt.show()
 
 
 
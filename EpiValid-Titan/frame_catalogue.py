@@ -0,0 +1,115 @@
+import os
+import re
+
+import numpy as np
+
+# <nanosecond timestamp>_<camera id>.<ext>, e.g. 1693123178400000000_3.jpg
+TITAN_NAME = re.compile(r'(\d+)_(\d+)\.\w+')
+
+
+class FrameCatalogue:
+    # frames of a multi-camera capture indexed by camera id and timestamp.
+    # per camera, timestamps are sorted and lookups are binary searches.
+    # frame indices refer to the order of the names given, which is the
+    # camera order of a CameraArray when built with from_cameras
+    def __init__(self, names):
+        parsed = [(i, TITAN_NAME.fullmatch(os.path.basename(name))) for i, name in enumerate(names)]
+        parsed = [(i, int(m[1]), int(m[2])) for i, m in parsed if m is not None]
+        self.names = list(names)
+        self._timestamps = dict()
+        self._indices = dict()
+        if not parsed:
+            return
+        indices, timestamps, camera_ids = (np.array(col, dtype=np.int64) for col in zip(*parsed))
+        order = np.lexsort((timestamps, camera_ids))
+        indices, timestamps, camera_ids = indices[order], timestamps[order], camera_ids[order]
+        bounds = np.flatnonzero(np.diff(camera_ids)) + 1
+        for ids, ts, idx in zip(np.split(camera_ids, bounds), np.split(timestamps, bounds),
+                                np.split(indices, bounds)):
+            self._timestamps[int(ids[0])] = ts
+            self._indices[int(ids[0])] = idx
+
+    @classmethod
+    def from_folder(cls, folder):
+        # frame indices are positions in the sorted directory listing
+        return cls(sorted(entry.name for entry in os.scandir(folder) if entry.is_file()))
+
+    @classmethod
+    def from_cameras(cls, cameras):
+        if hasattr(cameras, 'image_paths') and cameras.image_paths is not None:
+            return cls(list(cameras.image_paths))
+        return cls([cam.image_path or '' for cam in cameras])
+
+    def __len__(self):
+        return sum(len(ts) for ts in self._timestamps.values())
+
+    def __repr__(self) -> str:
+        return f'FrameCatalogue({len(self)} frames, cameras {self.camera_ids})'
+
+    @property
+    def camera_ids(self):
+        return sorted(self._timestamps)
+
+    def has_cameras(self, camera_ids):
+        return all(cid in self._timestamps for cid in camera_ids)
+
+    def timestamps(self, camera_id):
+        # sorted (n,) int64 nanoseconds of one camera
+        return self._timestamps[camera_id]
+
+    def frames(self, camera_id):
+        # frame indices of one camera, in timestamp order
+        return self._indices[camera_id]
+
+    def position(self, camera_id, timestamp):
+        # position in the timestamp order of camera_id of its frame closest
+        # in time, timestamp may be an array for many lookups at once
+        ts = self._timestamps[camera_id]
+        timestamp = np.asarray(timestamp, dtype=np.int64)
+        after = np.minimum(np.searchsorted(ts, timestamp), len(ts) - 1)
+        before = np.maximum(after - 1, 0)
+        return np.where(np.abs(timestamp - ts[before]) <= np.abs(ts[after] - timestamp), before, after)
+
+    def nearest(self, camera_id, timestamp):
+        # (frame index, timestamp) of the frame of camera_id closest in time
+        pos = self.position(camera_id, timestamp)
+        return self._indices[camera_id][pos], self._timestamps[camera_id][pos]
+
+    def group(self, timestamp, camera_ids, tolerance=None):
+        # frame index per camera nearest to timestamp, None where the
+        # nearest frame is more than tolerance nanoseconds away
+        ret = []
+        for cid in camera_ids:
+            index, ts = self.nearest(cid, timestamp)
+            ok = tolerance is None or abs(int(ts) - int(timestamp)) <= tolerance
+            ret.append(int(index) if ok else None)
+        return ret
+
+    def group_at(self, frame_number, camera_ids, tolerance=None, offsets=None):
+        # the group of the frame_number-th frame of camera_ids[0].
+        # offsets: frames each camera steps from its closest frame, in its
+        # own timestamp order, as solved by offset_search.py for clocks that
+        # are off. tolerance applies to the closest frames
+        timestamp = self._timestamps[camera_ids[0]][frame_number]
+        group = self.group(timestamp, camera_ids, tolerance)
+        if offsets is None:
+            return group
+        ret = []
+        for cid, offset, index in zip(camera_ids, offsets, group):
+            pos = int(self.position(cid, timestamp)) + offset
+            if not 0 <= pos < len(self._indices[cid]):
+                raise IndexError(f'Offset {offset} of camera {cid} leaves its {len(self._indices[cid])} frames')
+            ret.append(None if index is None else int(self._indices[cid][pos]))
+        return ret
+
+    def groups(self, camera_ids, tolerance=None):
+        # (timestamp, (len(camera_ids),) frame indices) for every frame of the
+        # reference camera camera_ids[0], -1 where nothing is within tolerance
+        ref = self._timestamps[camera_ids[0]]
+        table = np.empty((len(ref), len(camera_ids)), dtype=np.int64)
+        for k, cid in enumerate(camera_ids):
+            index, ts = self.nearest(cid, ref)
+            if tolerance is not None:
+                index = np.where(np.abs(ts - ref) <= tolerance, index, -1)
+            table[:, k] = index
+        return zip(ref, table)
@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from epipolar import ComputeFundamentalBatch
+from epivalid import MULTI_CO_LIST, RING_CAMERA_IDS
+from batch_validate import validate_pair
+from frame_catalogue import FrameCatalogue
+
+
+def _ring_blocks(img_step):
+    # first camera index of the frame block of each ring camera
+    return [(m if m < 3 else m - 1) * img_step for m in MULTI_CO_LIST]
+
+
+def _ring_frames(cameras, photo_index, img_step, catalogue):
+    # per ring camera, its camera indices in frame order and the position in
+    # them of group photo_index at zero offset, the index space of the
+    # offsets epivalid.select_group applies. timestamp-named captures follow
+    # the catalogue, other datasets the blocks of img_step frames
+    if catalogue.has_cameras(RING_CAMERA_IDS):
+        timestamp = catalogue.timestamps(RING_CAMERA_IDS[0])[photo_index]
+        return ([catalogue.frames(cid) for cid in RING_CAMERA_IDS],
+                [int(catalogue.position(cid, timestamp)) for cid in RING_CAMERA_IDS])
+    frames = [np.arange(block, min(block + img_step, len(cameras))) for block in _ring_blocks(img_step)]
+    return frames, [photo_index] * len(frames)
+
+
+def _score_task(task):
+    # median Sampson error, or inf below min_matches
+    args, min_matches = task
+    result = validate_pair(*args)
+    num_matches, sampson_median = result[0], result[1]
+    if num_matches < min_matches or not np.isfinite(sampson_median):
+        return np.inf, num_matches
+    return sampson_median, num_matches
+
+
+def score_candidates(pool, cameras, main_folder, left, candidates, matcher='bf',
+                     feature_cache=None, levels=(4, 1), keep=3, min_matches=20):
+    # scores of camera indices candidates against camera left, lower is better.
+    # every level scores the surviving candidates in parallel on images
+    # reduced by that factor, only the keep best go on to the next level
+    scores = np.full(len(candidates), np.inf)
+    alive = np.arange(len(candidates))
+    pairs = np.stack([np.full(len(candidates), left), candidates], axis=1)
+    fmats = ComputeFundamentalBatch(cameras, pairs)
+    cam_left = cameras[int(left)]
+    path_left = os.path.join(main_folder, "images", cam_left.image_path)
+    for depth, reduction in enumerate(levels):
+        tasks = []
+        for k in alive:
+            cam = cameras[int(candidates[k])]
+            tasks.append(((fmats[k], path_left, os.path.join(main_folder, "images", cam.image_path),
+                           cam_left.sensor, cam.sensor, matcher, feature_cache, reduction),
+                          min_matches))
+        level_scores = np.array([score for score, _ in pool.map(_score_task, tasks)])
+        finite = alive[np.isfinite(level_scores)]
+        if depth > 0 and len(finite) == 0:
+            # nothing left at this resolution, keep the coarser ranking
+            break
+        scores[:] = np.inf
+        scores[alive] = level_scores
+        if depth == len(levels) - 1 or len(finite) <= 1:
+            break
+        alive = finite[np.argsort(scores[finite], kind='stable')[:keep]]
+    return scores
+
+
+def search_group(pool, cameras, main_folder, photo_index, img_step, prior=None, radius=20,
+                 catalogue=None, **kwargs):
+    # offsets of one ring group, each ring camera against its already
+    # solved predecessor. prior: offsets the search windows are centred on.
+    # returns offsets and the median Sampson error of each camera
+    # against its predecessor (nan for the first one)
+    num = len(MULTI_CO_LIST)
+    prior = [0] * num if prior is None else list(prior)
+    if catalogue is None:
+        catalogue = FrameCatalogue.from_cameras(cameras)
+    frames, bases = _ring_frames(cameras, photo_index, img_step, catalogue)
+    offsets = [0] * num
+    errors = [np.nan] * num
+    for i in range(1, num):
+        left = frames[i - 1][bases[i - 1] + offsets[i - 1]]
+        window = bases[i] + prior[i] + np.arange(-radius, radius + 1)
+        # stay inside the frames of this camera
+        window = window[(window >= 0) & (window < len(frames[i]))]
+        if len(window) == 0:
+            raise ValueError('No candidate frames for ring camera %d of group %d' % (i, photo_index))
+        scores = score_candidates(pool, cameras, main_folder, left, frames[i][window], **kwargs)
+        best = int(np.argmin(scores))
+        offsets[i] = int(window[best] - bases[i])
+        errors[i] = float(scores[best])
+        print('GROUP', photo_index, 'camera', i, 'offset', offsets[i], 'sampson_median %.3f' % errors[i])
+    return offsets, errors
+
+
+def search_offsets(cameras, main_folder, photo_indices, img_step, radius=20, workers=None,
+                   matcher='bf', feature_cache=None, levels=(4, 1), keep=3, min_matches=20,
+                   catalogue=None):
+    # {photo_index: (offsets, errors)} for every group, each group's search
+    # is centred on the offsets of the group before it
+    if feature_cache is None:
+        feature_cache = os.path.join(main_folder, "features")
+    if catalogue is None:
+        catalogue = FrameCatalogue.from_cameras(cameras)
+    table = dict()
+    prior = None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for photo_index in photo_indices:
+            offsets, errors = search_group(pool, cameras, main_folder, photo_index, img_step,
+                                           prior, radius, catalogue, matcher=matcher,
+                                           feature_cache=feature_cache, levels=levels,
+                                           keep=keep, min_matches=min_matches)
+            table[int(photo_index)] = (offsets, errors)
+            prior = offsets
+    return table
+
+
+def write_offsets(path, table, img_step):
+    with open(path, 'w') as f:
+        json.dump(dict(img_step=img_step,
+                       groups={str(k): dict(offsets=offsets,
+                                            sampson_median=[None if np.isnan(e) else e for e in errors])
+                               for k, (offsets, errors) in table.items()}), f, indent=1)
+
+
+def read_offsets(path):
+    # {photo_index: offsets}
+    with open(path, 'r') as f:
+        js = json.load(f)
+    return {int(k): v['offsets'] for k, v in js['groups'].items()}
+
+
+def group_offsets(table, photo_index):
+    # offsets of the solved group nearest to photo_index
+    nearest = min(table, key=lambda k: abs(k - photo_index))
+    return table[nearest]
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description='Search the frame offset of every ring camera, per group, by epipolar consistency')
+    parser.add_argument('cameras_json', help='path to cameras json')
+    parser.add_argument('img_step', type=int,
+                        help='frames per camera in the json, unused for timestamp-named captures')
+    parser.add_argument('groups', type=int, nargs='*',
+                        help='photo index of each group, default every --group-step frames')
+    parser.add_argument('--group-step', type=int, default=100)
+    parser.add_argument('--radius', type=int, default=20, help='frames searched on each side of the prior')
+    parser.add_argument('--levels', type=int, nargs='+', default=[4, 1], choices=[1, 2, 4, 8],
+                        help='image reductions of the pruning levels, coarse to fine')
+    parser.add_argument('--keep', type=int, default=3, help='candidates kept from one level to the next')
+    parser.add_argument('--min-matches', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--matcher', choices=['bf', 'flann', 'mutual'], default='bf')
+    parser.add_argument('--feature-cache', default=None, help='default DATASET/features')
+    parser.add_argument('--output', default='offsets.json')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    from parse_whkrt import parse_nerf
+    cameras = parse_nerf(args.cameras_json)
+    main_folder = os.path.dirname(args.cameras_json)
+    catalogue = FrameCatalogue.from_cameras(cameras)
+    # groups are frame numbers of the first ring camera
+    num_frames = len(catalogue.frames(RING_CAMERA_IDS[0])) if catalogue.has_cameras(RING_CAMERA_IDS) \
+        else args.img_step
+    groups = args.groups or list(range(0, num_frames, args.group_step))
+    table = search_offsets(cameras, main_folder, groups, args.img_step, args.radius, args.workers,
+                           args.matcher, args.feature_cache, args.levels, args.keep, args.min_matches,
+                           catalogue)
+    write_offsets(args.output, table, args.img_step)
+    # in the format of the tables in epivalid.select_ring
+    for photo_index, (offsets, _) in table.items():
+        print('offsets = %s  # Group %d' % (offsets, photo_index))
@@ -1,16 +1,25 @@
 import json
+import mmap
 import os
+from functools import partial
 
 import numpy as np
 from scipy.spatial.transform.rotation import Rotation
 
 from scene import *
+from calib_cache import cached
 
 
-def parse(path_js):
+def parse(path_js, use_cache=True):
     with open(path_js, 'r') as f:
         js = json.load(f)
+    if not use_cache:
+        return _parse(js)
+    sources = [path_js] + [js[k] for k in ['intrs', 'c2ws', 'res', 'dists'] if k in js]
+    return cached(path_js, sources, partial(_parse, js))
 
+
+def _parse(js):
     Ks = np.loadtxt(js['intrs'])
     num_k = len(Ks)
     assert Ks.shape == (num_k, 9)
@@ -26,31 +35,115 @@ def parse(path_js):
     else:
         dists = np.zeros((num_k, 0))
 
-    cams = dict()
-    for i, (K, c2w, wh, dd) in enumerate(zip(Ks, c2ws, ress, dists)):
-        width, height = wh
-        fx, fy, cx, cy = K[[0, 4, 2, 5]]
-        cx -= (width - 1) / 2
-        cy -= (height - 1) / 2
-        pin = Pinhole(fx, fy, cx, cy)
-        res = Resolution(*wh)
-        dist = Distortion(*dd)
-        ssr = Sensor(res, pin, dist)
-
-        c2w_mat = c2w.reshape(3, 4)
-        rvec = Rotation.from_matrix(c2w_mat[:3, :3]).as_rotvec()
-        rt = np.concatenate([rvec, c2w_mat[:3, 3]])
-        tsfm = Transform(rt)
-        pose = Pose(tsfm, is_to_local=False)
-
-        cam = Camera(i, ssr, pose)
-        cams[i] = cam
-    return cams
-
-def parse_nerf(path_js):
+    dists = np.pad(dists, ((0, 0), (0, 5 - dists.shape[1])))
+
+    intrs = Ks[:, [0, 4, 2, 5]]
+    intrs[:, 2] -= (ress[:, 0] - 1) / 2
+    intrs[:, 3] -= (ress[:, 1] - 1) / 2
+
+    c2w_mats = c2ws.reshape(-1, 3, 4)
+    rvecs = Rotation.from_matrix(c2w_mats[:, :, :3]).as_rotvec()
+    rts = np.concatenate([rvecs, c2w_mats[:, :, 3]], axis=1)
+
+    return CameraArray(rts, intrs, dists, ress, is_to_local=False)
+
+class _JsonStream:
+    # incremental reader for the top level of a JSON object,
+    # keeps only the undecoded tail of the file in memory
+    _ws = ' \t\r\n'
+    _delims = tuple(_ws + ',]}')
+
+    def __init__(self, f, block_size=1 << 20):
+        self._f = f
+        self._block_size = block_size
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        block = self._f.read(self._block_size)
+        self._eof = not block
+        self._buf = self._buf[self._pos:] + block
+        self._pos = 0
+        return not self._eof
+
+    def peek(self):
+        # next non-whitespace char, '' at end of file
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in self._ws:
+                self._pos += 1
+            if self._pos < len(self._buf) or not self._fill():
+                return self._buf[self._pos:self._pos + 1]
+
+    def expect(self, chars):
+        char = self.peek()
+        if char == '' or char not in chars:
+            raise ValueError(f'Malformed JSON: expected one of {chars!r}, got {char!r}')
+        self._pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                ret, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number may be cut at the block boundary, only trust it
+                # if a delimiter follows. strings, objects and arrays end
+                # on their own closing character
+                if self._eof or type(ret) not in (int, float) or self._buf[end:end + 1] in self._delims:
+                    self._pos = end
+                    return ret
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+
+def _iter_nerf_js(f):
+    # yields (key, value) of the top level object, with the value of
+    # "frames" replaced by a generator that must be consumed in place
+    stream = _JsonStream(f)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == 'frames':
+            yield key, _iter_json_array(stream)
+        else:
+            yield key, stream.value()
+        if stream.expect(',}') == '}':
+            return
+
+
+def _iter_json_array(stream):
+    stream.expect('[')
+    if stream.peek() == ']':
+        stream.expect(']')
+        return
+    while True:
+        yield stream.value()
+        if stream.expect(',]') == ']':
+            return
+
+
+def _nerf_header(path_js):
+    # every top level field except frames, skipping over frames
+    # one at a time if they come before the intrinsics
+    header = dict()
     with open(path_js, 'r') as f:
-        js = json.load(f)
+        for key, value in _iter_nerf_js(f):
+            if key == 'frames':
+                for _ in value:
+                    pass
+            else:
+                header[key] = value
+    return header
 
+
+def _nerf_sensor(js):
     width = js["w"]
     height = js["h"]
     fx = js["fl_x"]
@@ -64,7 +157,7 @@ def parse_nerf(path_js):
         K3 = js["K3"]
         P1 = js["P1"]
         P2 = js["P2"]
-    except:
+    except KeyError:
         K1 = 0
         K2 = 0
         K3 = 0
@@ -73,27 +166,181 @@ def parse_nerf(path_js):
 
     cx -= (width - 1) / 2
     cy -= (height - 1) / 2
+    return [fx, fy, cx, cy], [K1, K2, P1, P2, K3], [width, height]
+
+
+def _nerf_frames_to_cameras(frames, sensor):
+    intr, dist, res = sensor
+    num = len(frames)
+    c2ws = np.array([frame["transform_matrix"] for frame in frames], dtype=float)
+    c2ws = c2ws.reshape(num, -1, 4)[:, :3]
+    c2ws[:, :, 1:3] = -c2ws[:, :, 1:3] # reverse Y and Z axis
+    image_paths = [os.path.basename(frame["file_path"]) for frame in frames]
+
+    rvecs = Rotation.from_matrix(c2ws[:, :, :3]).as_rotvec()
+    rts = np.concatenate([rvecs, c2ws[:, :, 3]], axis=1)
+
+    # all frames share one sensor
+    return CameraArray(rts, np.tile(intr, (num, 1)), np.tile(dist, (num, 1)),
+                       np.tile(res, (num, 1)), image_paths,
+                       np.zeros(num, dtype=int), is_to_local=False)
+
+
+def parse_nerf_chunks(path_js, chunk_size=1024):
+    # yields CameraArrays of up to chunk_size consecutive frames while the
+    # file is read, frame k of the file is row k % chunk_size of chunk
+    # k // chunk_size. memory stays bounded by the chunk size
+    sensor = None
+    with open(path_js, 'r') as f:
+        header = dict()
+        for key, value in _iter_nerf_js(f):
+            if key != 'frames':
+                header[key] = value
+                continue
+            if sensor is None:
+                try:
+                    sensor = _nerf_sensor(header)
+                except KeyError:
+                    # intrinsics stored after frames, read them first
+                    sensor = _nerf_sensor(_nerf_header(path_js))
+            chunk = []
+            for frame in value:
+                chunk.append(frame)
+                if len(chunk) == chunk_size:
+                    yield _nerf_frames_to_cameras(chunk, sensor)
+                    chunk = []
+            if chunk:
+                yield _nerf_frames_to_cameras(chunk, sensor)
+
+
+def _parse_nerf(path_js):
+    return CameraArray.concatenate(list(parse_nerf_chunks(path_js)))
+
+
+def parse_nerf(path_js, use_cache=True):
+    if not use_cache:
+        return _parse_nerf(path_js)
+    return cached(path_js, [path_js], partial(_parse_nerf, path_js))
+
+
+# COLMAP camera model id -> (name, number of params)
+COLMAP_MODELS = {
+    0: ('SIMPLE_PINHOLE', 3), 1: ('PINHOLE', 4), 2: ('SIMPLE_RADIAL', 4), 3: ('RADIAL', 5),
+    4: ('OPENCV', 8), 5: ('OPENCV_FISHEYE', 8), 6: ('FULL_OPENCV', 12), 7: ('FOV', 5),
+    8: ('SIMPLE_RADIAL_FISHEYE', 4), 9: ('RADIAL_FISHEYE', 5), 10: ('THIN_PRISM_FISHEYE', 12),
+}
+# params of the models this camera model holds, in the order fx fy cx cy k1 k2 p1 p2 k3.
+# FULL_OPENCV is only accepted with k4 = k5 = k6 = 0
+_COLMAP_TO_OPENCV = {
+    0: [0, 0, 1, 2], 1: [0, 1, 2, 3], 2: [0, 0, 1, 2, 3], 3: [0, 0, 1, 2, 3, 4],
+    4: [0, 1, 2, 3, 4, 5, 6, 7], 6: [0, 1, 2, 3, 4, 5, 6, 7, 8],
+}
+_COLMAP_CAMERA = np.dtype([('camera_id', '<i4'), ('model_id', '<i4'), ('width', '<u8'), ('height', '<u8')])
+# fixed part of an images.bin record, followed by the null terminated
+# name, the number of 2D points and 24 bytes per point
+_COLMAP_IMAGE = np.dtype([('image_id', '<i4'), ('qvec', '<f8', 4), ('tvec', '<f8', 3), ('camera_id', '<i4')])
+
+
+def _colmap_num_params(model_id):
+    if model_id not in COLMAP_MODELS:
+        raise ValueError(f'Unknown COLMAP camera model id {model_id}')
+    return COLMAP_MODELS[model_id][1]
+
+
+def _read_colmap_cameras(path):
+    # (C,) records of _COLMAP_CAMERA and (C, 12) zero padded params
+    with open(path, 'rb') as f:
+        data = f.read()
+    num = int(np.frombuffer(data, '<u8', 1)[0])
+    heads = np.zeros(num, dtype=_COLMAP_CAMERA)
+    params = np.zeros((num, 12))
+    if num == 0:
+        return heads, params
+    # one read when all cameras share the model of the first one
+    num_params = _colmap_num_params(int(np.frombuffer(data, _COLMAP_CAMERA, 1, 8)['model_id'][0]))
+    record = np.dtype(_COLMAP_CAMERA.descr + [('params', '<f8', (num_params,))])
+    if len(data) == 8 + num * record.itemsize:
+        records = np.frombuffer(data, record, num, 8)
+        if np.all(records['model_id'] == records['model_id'][0]):
+            heads[:] = records[list(_COLMAP_CAMERA.names)]
+            params[:, :num_params] = records['params']
+            return heads, params
+    pos = 8
+    for k in range(num):
+        heads[k] = np.frombuffer(data, _COLMAP_CAMERA, 1, pos)[0]
+        num_params = _colmap_num_params(int(heads['model_id'][k]))
+        params[k, :num_params] = np.frombuffer(data, '<f8', num_params, pos + _COLMAP_CAMERA.itemsize)
+        pos += _COLMAP_CAMERA.itemsize + 8 * num_params
+    if pos != len(data):
+        raise ValueError(f'Malformed COLMAP cameras file {path}')
+    return heads, params
+
+
+def _read_colmap_images(path):
+    # (N,) records of _COLMAP_IMAGE and the N image names. the file is
+    # memory-mapped, the loop only finds where each record starts and
+    # skips over the 2D points, which are never read
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        num = int.from_bytes(mm[:8], 'little')
+        offsets = np.empty(num, dtype=np.int64)
+        names = []
+        pos = 8
+        size = _COLMAP_IMAGE.itemsize
+        for k in range(num):
+            offsets[k] = pos
+            end = mm.find(b'\0', pos + size)
+            if end < 0:
+                raise ValueError(f'Malformed COLMAP images file {path}')
+            names.append(mm[pos + size:end].decode())
+            pos = end + 9 + 24 * int.from_bytes(mm[end + 1:end + 9], 'little')
+        if pos != len(mm):
+            raise ValueError(f'Malformed COLMAP images file {path}')
+        buf = np.frombuffer(mm, np.uint8)
+        heads = buf[offsets[:, None] + np.arange(size)].view(_COLMAP_IMAGE)[:, 0]
+        # release the buffer before the mapping is closed
+        del buf
+    return heads, names
+
 
-    pin = Pinhole(fx, fy, cx, cy)
+def _parse_colmap(path):
+    cameras, params = _read_colmap_cameras(os.path.join(path, 'cameras.bin'))
+    images, names = _read_colmap_images(os.path.join(path, 'images.bin'))
 
-    
-    res = Resolution(width, height)
-    
-    dist = Distortion(K1, K2, P1, P2, K3)
+    opencv = np.zeros((len(cameras), 9))
+    for model_id in np.unique(cameras['model_id']):
+        if model_id not in _COLMAP_TO_OPENCV:
+            raise ValueError(f'Unsupported COLMAP camera model {COLMAP_MODELS[model_id][0]}')
+        mask = cameras['model_id'] == model_id
+        index = _COLMAP_TO_OPENCV[model_id]
+        opencv[mask, :len(index)] = params[mask][:, index]
+        if model_id == 6 and np.any(params[mask, 9:12] != 0):
+            raise ValueError('FULL_OPENCV cameras with k4, k5 or k6 are not supported')
+    resolutions = np.stack([cameras['width'], cameras['height']], axis=1).astype(int)
+    # COLMAP puts pixel centres at +0.5, so the centre of the image is at
+    # (width / 2, height / 2) rather than ((width - 1) / 2, (height - 1) / 2)
+    opencv[:, 2:4] -= resolutions / 2
 
-    cams = dict()
+    # images sharing a COLMAP camera share its sensor
+    if not np.all(np.isin(images['camera_id'], cameras['camera_id'])):
+        raise ValueError('COLMAP images refer to cameras missing from cameras.bin')
+    if len(images) == 0:
+        return CameraArray.concatenate([])
+    order = np.argsort(cameras['camera_id'])
+    rows = order[np.searchsorted(cameras['camera_id'], images['camera_id'], sorter=order)]
 
-    for i, frame in enumerate(js["frames"]):
-        c2w = np.array(frame["transform_matrix"])
-        image_path = os.path.basename(frame["file_path"])
-        c2w[:, 1:3] = -c2w[:, 1:3] # reverse Y and Z axis
-        #print(c2w)
-        rvec = Rotation.from_matrix(c2w[:3, :3]).as_rotvec()
-        rt = np.concatenate([rvec, c2w[:3, 3]])
-        tsfm = Transform(rt)
-        pose = Pose(tsfm, is_to_local=False)
+    order = np.argsort(images['image_id'], kind='stable')
+    images, rows = images[order], rows[order]
+    # qvec is w x y z, scipy wants x y z w
+    rvecs = Rotation.from_quat(images['qvec'][:, [1, 2, 3, 0]]).as_rotvec()
+    rts = np.concatenate([rvecs, images['tvec']], axis=1)
+    return CameraArray(rts, opencv[rows, :4], opencv[rows, 4:], resolutions[rows],
+                       np.array(names)[order], images['camera_id'], is_to_local=True)
 
-        cam = Camera(i, Sensor(res, pin, dist), pose, image_path)
-        cams[i] = cam
 
-    return cams
+def parse_colmap(path, use_cache=True):
+    # path: COLMAP sparse model folder with cameras.bin and images.bin,
+    # poses are world to camera in opencv axes as COLMAP stores them
+    sources = [os.path.join(path, name) for name in ['cameras.bin', 'images.bin']]
+    if not use_cache:
+        return _parse_colmap(path)
+    return cached(sources[1], sources, partial(_parse_colmap, path))
@@ -1,23 +1,50 @@
 from typing import Optional, List, Hashable, Tuple, NamedTuple
 
 import numpy as np
-from se3_vec import SE3VecInv
+from se3_vec import SE3VecInv, SE3VecToMat
+
+
+def _param(index: int, doc: str):
+    # attribute stored in slot index of the packed parameter row
+    def fget(self):
+        return self._params[index]
+
+    def fset(self, value):
+        self._params[index] = value
+    return property(fget, fset, doc=doc)
+
+
+def _view(cls, row: np.ndarray, size: int):
+    # instance of cls sharing memory with row, no copy
+    assert row.shape == (size,) and row.dtype == np.float64
+    ret = cls.__new__(cls)
+    ret._params = row
+    return ret
 
 
 class Transform:
+    __slots__ = ('_ary',)
+
     def __init__(self, rt_vec: np.ndarray = np.zeros(6)):
         self._ary = np.empty(6)
         self.vector = rt_vec
-        self._rot = self._ary[:3]
-        self._trans = self._ary[3:]
+
+    @classmethod
+    def view(cls, rt_vec: np.ndarray):
+        # Transform over a (6,) row of a larger pose array, no copy,
+        # setting vector writes through to the array
+        assert rt_vec.shape == (6,) and rt_vec.dtype == np.float64
+        ret = cls.__new__(cls)
+        ret._ary = rt_vec
+        return ret
 
     @property
     def rotation(self):
-        return self._rot
+        return self._ary[:3]
 
     @property
     def translation(self):
-        return self._trans
+        return self._ary[3:]
 
     @property
     def vector(self):
@@ -29,10 +56,12 @@ class Transform:
         self._ary[:] = x[:]
 
     def inverse(self):
-        return Transform(SE3VecInv(self._ary))
+        return Transform.view(SE3VecInv(self._ary))
 
 
 class Pose:
+    __slots__ = ('transform', 'is_to_local')
+
     def __init__(self, transform: Optional[Transform] = None,
                  is_to_local: bool = True):
         self.transform: Transform = Transform() if transform is None else transform
@@ -43,11 +72,21 @@ class Pose:
 
 
 class Pinhole:
+    # fx fy cx cy packed in one (4,) row, which may be a view into the
+    # intrinsics of a CameraArray
+    __slots__ = ('_params',)
+
     def __init__(self, fx: float, fy: float, cx: float, cy: float):
-        self.fx = fx
-        self.fy = fy
-        self.cx = cx
-        self.cy = cy
+        self._params = np.array([fx, fy, cx, cy], dtype=float)
+
+    @classmethod
+    def view(cls, params: np.ndarray):
+        return _view(cls, params, 4)
+
+    fx = _param(0, 'focal length x')
+    fy = _param(1, 'focal length y')
+    cx = _param(2, 'principal point x, relative to the image centre')
+    cy = _param(3, 'principal point y, relative to the image centre')
 
     def matrix(self):
         return np.array([
@@ -61,13 +100,22 @@ class Pinhole:
 
 
 class Distortion:
+    # k1 k2 p1 p2 k3 packed in one (5,) row, in OpenCV order
+    __slots__ = ('_params',)
+
     def __init__(self, k1: float = 0.0, k2: float = 0.0,
                  p1: float = 0.0, p2: float = 0.0, k3: float = 0.0):
-        self.k1 = k1
-        self.k2 = k2
-        self.p1 = p1
-        self.p2 = p2
-        self.k3 = k3
+        self._params = np.array([k1, k2, p1, p2, k3], dtype=float)
+
+    @classmethod
+    def view(cls, params: np.ndarray):
+        return _view(cls, params, 5)
+
+    k1 = _param(0, 'radial k1')
+    k2 = _param(1, 'radial k2')
+    p1 = _param(2, 'tangential p1')
+    p2 = _param(3, 'tangential p2')
+    k3 = _param(4, 'radial k3')
 
 
 class Resolution(NamedTuple):
@@ -76,6 +124,8 @@ class Resolution(NamedTuple):
 
 
 class Sensor:
+    __slots__ = ('_resolution', 'pinhole', 'distortion')
+
     def __init__(self, resolution: Optional[Resolution] = None,
                  pinhole: Optional[Pinhole] = None, distortion: Optional[Distortion] = None):
         self._resolution: Optional[Resolution] = resolution
@@ -96,12 +146,162 @@ class Sensor:
 
 
 class Camera:
+    __slots__ = ('camera_id', 'sensor', 'pose', 'image_path', '_state', '_derived')
+
     def __init__(self, camera_id: Hashable, sensor: Optional[Sensor] = None,
                  pose: Optional[Pose] = None, image_path = None):
         self.camera_id = camera_id
         self.sensor: Sensor = Sensor() if sensor is None else sensor
         self.pose: Pose = Pose() if pose is None else pose
         self.image_path = image_path
+        self._state = None
+        self._derived = dict()
 
     def __hash__(self):
         return hash(self.camera_id)
+
+    def _cached(self, name, compute):
+        # derived matrices are recomputed only when the pose or the sensor
+        # changed since they were cached, however they were changed
+        # (setters, in-place writes, rows of a CameraArray)
+        pinhole = self.sensor.pinhole
+        state = (self.pose.transform.vector.tobytes(), self.pose.is_to_local, id(self.sensor),
+                 None if pinhole is None else pinhole._params.tobytes(), self.sensor.resolution)
+        if state != self._state:
+            self._state = state
+            self._derived = dict()
+        ret = self._derived.get(name)
+        if ret is None:
+            ret = compute()
+            ret.flags.writeable = False
+            self._derived[name] = ret
+        return ret
+
+    def _extrinsic(self):
+        rot, trans = SE3VecToMat(self.pose.transform.vector)
+        ret = np.eye(4)
+        if self.pose.is_to_local:
+            ret[:3, :3] = rot
+            ret[:3, 3] = trans
+        else:
+            ret[:3, :3] = rot.T
+            ret[:3, 3] = -rot.T @ trans
+        return ret
+
+    def _intrinsic(self):
+        w, h = self.sensor.resolution
+        fx, fy, cx, cy = self.sensor.pinhole._params
+        return np.array([
+            [fx, 0, cx + (w-1)/2],
+            [0, fy, cy + (h-1)/2],
+            [0, 0, 1]
+        ])
+
+    def _intrinsic_inverse(self):
+        w, h = self.sensor.resolution
+        fx, fy, cx, cy = self.sensor.pinhole._params
+        return np.array([
+            [1 / fx, 0, -(cx + (w-1)/2) / fx],
+            [0, 1 / fy, -(cy + (h-1)/2) / fy],
+            [0, 0, 1]
+        ])
+
+    @property
+    def extrinsic(self) -> np.ndarray:
+        # (4, 4) world to camera, read-only
+        return self._cached('extrinsic', self._extrinsic)
+
+    @property
+    def intrinsic(self) -> np.ndarray:
+        # (3, 3) pinhole matrix in pixels, read-only
+        return self._cached('intrinsic', self._intrinsic)
+
+    @property
+    def intrinsic_inverse(self) -> np.ndarray:
+        # (3, 3) inverse pinhole matrix in closed form, read-only
+        return self._cached('intrinsic_inverse', self._intrinsic_inverse)
+
+    @property
+    def projection(self) -> np.ndarray:
+        # (3, 4) world to pixels, read-only
+        return self._cached('projection', lambda: self.intrinsic @ self.extrinsic[:3])
+
+    @property
+    def centre(self) -> np.ndarray:
+        # (3,) camera centre in world coordinates, read-only
+        return self._cached('centre', lambda: -self.extrinsic[:3, :3].T @ self.extrinsic[:3, 3])
+
+
+class CameraArray:
+    # struct-of-arrays camera storage, row i is camera i
+    # poses (N, 6) rotvec + translation, intrinsics (N, 4) fx fy cx cy
+    # (principal point relative to image centre, as in Pinhole),
+    # distortions (N, 5) k1 k2 p1 p2 k3, resolutions (N, 2) width height,
+    # sensor_ids (N,) rows sharing an id share one physical sensor.
+    # cameras and sensors handed out are views: their Transform, Pinhole
+    # and Distortion share memory with the rows of these arrays
+    def __init__(self, poses: np.ndarray, intrinsics: np.ndarray,
+                 distortions: np.ndarray, resolutions: np.ndarray,
+                 image_paths: Optional[np.ndarray] = None,
+                 sensor_ids: Optional[np.ndarray] = None,
+                 is_to_local: bool = True):
+        num = len(poses)
+        self.poses = np.ascontiguousarray(poses, dtype=float).reshape(num, 6)
+        self.intrinsics = np.ascontiguousarray(intrinsics, dtype=float).reshape(num, 4)
+        self.distortions = np.ascontiguousarray(distortions, dtype=float).reshape(num, 5)
+        self.resolutions = np.ascontiguousarray(resolutions, dtype=int).reshape(num, 2)
+        self.image_paths = None if image_paths is None else np.asarray(image_paths, dtype=str)
+        self.sensor_ids = np.arange(num) if sensor_ids is None else np.asarray(sensor_ids, dtype=int)
+        self.is_to_local = is_to_local
+        self._sensors = dict()
+
+    @staticmethod
+    def concatenate(arrays):
+        arrays = list(arrays)
+        if not arrays:
+            return CameraArray(np.zeros((0, 6)), np.zeros((0, 4)),
+                               np.zeros((0, 5)), np.zeros((0, 2)))
+        has_paths = all(a.image_paths is not None for a in arrays)
+        return CameraArray(
+            np.concatenate([a.poses for a in arrays]),
+            np.concatenate([a.intrinsics for a in arrays]),
+            np.concatenate([a.distortions for a in arrays]),
+            np.concatenate([a.resolutions for a in arrays]),
+            np.concatenate([a.image_paths for a in arrays]) if has_paths else None,
+            np.concatenate([a.sensor_ids for a in arrays]),
+            arrays[0].is_to_local)
+
+    def __len__(self):
+        return len(self.poses)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.camera(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.camera(index)
+        return CameraArray(
+            self.poses[index], self.intrinsics[index],
+            self.distortions[index], self.resolutions[index],
+            None if self.image_paths is None else self.image_paths[index],
+            self.sensor_ids[index], self.is_to_local)
+
+    def __repr__(self) -> str:
+        return f'CameraArray({len(self)} cameras, {len(np.unique(self.sensor_ids))} sensors)'
+
+    def sensor(self, index: int) -> Sensor:
+        # one Sensor object per sensor id, shared by all its cameras
+        sensor_id = int(self.sensor_ids[index])
+        if sensor_id not in self._sensors:
+            self._sensors[sensor_id] = Sensor(
+                Resolution(*self.resolutions[index].tolist()),
+                Pinhole.view(self.intrinsics[index]),
+                Distortion.view(self.distortions[index]))
+        return self._sensors[sensor_id]
+
+    def camera(self, index: int) -> Camera:
+        index = range(len(self))[index]
+        pose = Pose(Transform.view(self.poses[index]), self.is_to_local)
+        image_path = None if self.image_paths is None else str(self.image_paths[index])
+        return Camera(index, self.sensor(index), pose, image_path)
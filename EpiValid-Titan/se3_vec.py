@@ -37,3 +37,42 @@ def SE3VecToMat(vec: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
     rot = AngleAxis2Mat(vec[:3])
     trans = vec[3:]
     return rot, trans
+
+
+def AngleAxis2MatBatch(rotvecs: np.ndarray) -> np.ndarray:
+    # (N, 3) rotation vectors to (N, 3, 3) matrices, Rodrigues' formula
+    # R = cos * I + (1 - cos) / angle^2 * v v^T + sin / angle * [v]x
+    # written with sinc so zero angles need no special case
+    vecs = rotvecs.reshape(-1, 3)
+    angles = np.linalg.norm(vecs, axis=1)
+    cos = np.cos(angles)
+    sin_by_angle = np.sinc(angles / np.pi)
+    one_minus_cos_by_angle2 = 0.5 * np.sinc(angles / (2 * np.pi)) ** 2
+    ret = np.einsum('n,ij->nij', cos, np.eye(3, dtype=vecs.dtype))
+    ret += one_minus_cos_by_angle2[:, None, None] * (vecs[:, :, None] * vecs[:, None, :])
+    rx, ry, rz = vecs[:, 0] * sin_by_angle, vecs[:, 1] * sin_by_angle, vecs[:, 2] * sin_by_angle
+    ret[:, 0, 1] -= rz
+    ret[:, 0, 2] += ry
+    ret[:, 1, 0] += rz
+    ret[:, 1, 2] -= rx
+    ret[:, 2, 0] -= ry
+    ret[:, 2, 1] += rx
+    return ret
+
+
+def SE3VecInvBatch(vecs: np.ndarray) -> np.ndarray:
+    assert vecs.ndim == 2 and vecs.shape[1] == 6
+    ret = np.empty_like(vecs)
+    ret[:, :3] = -vecs[:, :3]
+    ret[:, 3:] = -np.einsum('nij,nj->ni', AngleAxis2MatBatch(ret[:, :3]), vecs[:, 3:])
+    return ret
+
+
+def SE3VecToMatBatch(vecs: np.ndarray) -> np.ndarray:
+    # (N, 6) to (N, 4, 4) homogeneous matrices
+    assert vecs.ndim == 2 and vecs.shape[1] == 6
+    ret = np.zeros((len(vecs), 4, 4), dtype=vecs.dtype)
+    ret[:, :3, :3] = AngleAxis2MatBatch(vecs[:, :3])
+    ret[:, :3, 3] = vecs[:, 3:]
+    ret[:, 3, 3] = 1
+    return ret
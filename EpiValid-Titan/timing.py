@@ -0,0 +1,136 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+# disabled by default, span() then returns a shared no-op object and
+# latency() returns at once, so instrumented code pays one global lookup
+_enabled = False
+_origin = time.perf_counter()
+# (name, start, duration, thread id), appends are atomic under the GIL
+_events = []
+_latencies = defaultdict(list)
+
+# click-to-render histogram buckets, in milliseconds
+HISTOGRAM_EDGES = [0, 5, 10, 20, 35, 50, 75, 100, 150, 250, 500, 1000, np.inf]
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        _events.append((self.name, self.start, end - self.start, threading.get_ident()))
+        return False
+
+
+def span(name):
+    # with span('imread'): ... times the block under name
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def now():
+    return time.perf_counter()
+
+
+def latency(name, start):
+    # end of an interval started at start = now(), possibly on another
+    # call stack than the one that started it. kept for the histograms
+    if not _enabled:
+        return
+    end = time.perf_counter()
+    _events.append((name, start, end - start, threading.get_ident()))
+    _latencies[name].append(end - start)
+
+
+def enabled():
+    return _enabled
+
+
+def enable(summary=True, trace_path=None):
+    # summary: print the span table and latency histograms at exit,
+    # trace_path: write a Chrome trace (chrome://tracing, Perfetto) at exit
+    global _enabled
+    _enabled = True
+    if summary:
+        atexit.register(print_summary)
+    if trace_path is not None:
+        atexit.register(write_chrome_trace, trace_path)
+
+
+def reset():
+    _events.clear()
+    _latencies.clear()
+
+
+def stats():
+    # name -> count, total, mean, p50, p95, max, in seconds
+    durations = defaultdict(list)
+    for name, _, duration, _ in list(_events):
+        durations[name].append(duration)
+    ret = dict()
+    for name, values in durations.items():
+        values = np.array(values)
+        ret[name] = dict(count=len(values), total=values.sum(), mean=values.mean(),
+                         p50=np.percentile(values, 50), p95=np.percentile(values, 95),
+                         max=values.max())
+    return ret
+
+
+def histogram(name, edges=HISTOGRAM_EDGES):
+    # counts of latencies of name in the millisecond buckets edges
+    values = np.array(_latencies.get(name, [])) * 1e3
+    return np.histogram(values, bins=edges)[0]
+
+
+def print_summary():
+    table = stats()
+    if not table:
+        return
+    print('%-28s %7s %10s %9s %9s %9s %9s' % ('span', 'count', 'total ms', 'mean', 'p50', 'p95', 'max'))
+    for name, row in sorted(table.items(), key=lambda kv: -kv[1]['total']):
+        print('%-28s %7d %10.1f %9.2f %9.2f %9.2f %9.2f' % (
+            name, row['count'], row['total'] * 1e3, row['mean'] * 1e3,
+            row['p50'] * 1e3, row['p95'] * 1e3, row['max'] * 1e3))
+    for name in _latencies:
+        counts = histogram(name)
+        print('\n%s latency (ms)' % name)
+        for low, high, count in zip(HISTOGRAM_EDGES[:-1], HISTOGRAM_EDGES[1:], counts):
+            bar = '#' * int(round(40 * count / max(1, counts.max())))
+            print('%6g - %-6g %5d %s' % (low, high, count, bar))
+
+
+def write_chrome_trace(path):
+    # complete events ('X') in microseconds, one row per thread
+    pid = os.getpid()
+    events = [dict(name=name, ph='X', pid=pid, tid=tid,
+                   ts=(start - _origin) * 1e6, dur=duration * 1e6)
+              for name, start, duration, tid in list(_events)]
+    with open(path, 'w') as f:
+        json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
@@ -1,51 +1,215 @@
 import cv2
 import numpy as np
+import hashlib
 import os
 import random
+import tempfile
 
 def draw_epilines(img1, img2, pts1, pts2, F):
     # 计算epilines。 结果是 ax + by + c = 0 的形式
-    lines1 = cv2.computeCorrespondEpilines(pts2.reshape(-1, 1, 2), 2, F)
-    lines1 = lines1.reshape(-1, 3)
+    lines1 = epilines_batch(pts2, F, which_image=2)[0][0]
     img1_epilines = _drawlines(img1, lines1, pts1, pts2)
 
-    lines2 = cv2.computeCorrespondEpilines(pts1.reshape(-1, 1, 2), 1, F)
-    lines2 = lines2.reshape(-1, 3)
+    lines2 = epilines_batch(pts1, F, which_image=1)[0][0]
     img2_epilines = _drawlines(img2, lines2, pts2, pts1)
 
     return img1_epilines, img2_epilines
 
 def _drawlines(img, lines, pts1, pts2):
-    r, c = img.shape
-    for r, pt1, pt2 in zip(lines, pts1, pts2):
-        color = tuple(np.random.randint(0, 255, 3).tolist())
-        x0, y0 = map(int, [0, -r[2] / r[1]])
-        x1, y1 = map(int, [c, -(r[2] + r[0] * c) / r[1]])
-        img = cv2.line(img, (x0, y0), (x1, y1), color, 1)
-        img = cv2.circle(img, tuple(pt1), 5, color, -1)
+    return draw_lines_batch(img, lines, pts1)
+
+
+def epilines_batch(pts, fmats, sizes=None, which_image=1):
+    # M 个点 (M, 2) 在 K 个基础矩阵 (K, 3, 3) 下的极线, 一次计算, 没有 Python 循环.
+    # which_image 与 cv2.computeCorrespondEpilines 相同: 1 为 F x, 2 为 F^T x.
+    # 返回归一化 (a^2 + b^2 = 1) 的直线 (K, M, 3); sizes 为目标图像的 (width, height),
+    # (2,) 或 (K, 2), 给出时还返回裁剪到各目标图像的线段 (K, M, 2, 2) 和是否相交 (K, M)
+    pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+    fmats = np.asarray(fmats, dtype=np.float64).reshape(-1, 3, 3)
+    hom = np.concatenate([pts, np.ones((len(pts), 1))], axis=1)
+    if which_image == 1:
+        lines = np.einsum('kij,mj->kmi', fmats, hom)
+    else:
+        lines = np.einsum('kji,mj->kmi', fmats, hom)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lines /= np.hypot(lines[..., 0:1], lines[..., 1:2])
+    if sizes is None:
+        return lines, None, None
+    sizes = np.asarray(sizes, dtype=np.float64).reshape(-1, 1, 2)
+    segments, valid = clip_lines(lines, sizes[..., 0], sizes[..., 1])
+    return lines, segments, valid
+
+
+def clip_lines(lines, width, height):
+    # 直线 ax + by + c = 0 (..., 3) 与图像矩形 [0, width-1] x [0, height-1] 求交,
+    # width, height 为标量或可广播到 lines.shape[:-1] 的数组,
+    # 返回线段端点 (..., 2, 2) 和是否与图像相交 (...,), 接近竖直的直线也适用
+    lines = np.asarray(lines, dtype=np.float64)
+    a, b, c = lines[..., 0:1], lines[..., 1:2], lines[..., 2:3]
+    xmax = np.asarray(width, dtype=np.float64)[..., None] - 1
+    ymax = np.asarray(height, dtype=np.float64)[..., None] - 1
+    zeros = np.zeros(lines.shape[:-1] + (1,))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # 与 x = 0, x = xmax, y = 0, y = ymax 的交点
+        xs = np.concatenate([zeros, zeros + xmax, -c / a, -(b * ymax + c) / a], axis=-1)
+        ys = np.concatenate([-c / b, -(a * xmax + c) / b, zeros, zeros + ymax], axis=-1)
+    eps = 1e-6 * np.maximum(xmax, ymax)
+    inside = np.isfinite(xs) & np.isfinite(ys) \
+        & (xs >= -eps) & (xs <= xmax + eps) & (ys >= -eps) & (ys <= ymax + eps)
+    # 沿直线方向 (-b, a) 取最远的两个交点
+    t = -b * xs + a * ys
+    t_min = np.where(inside, t, np.inf).argmin(axis=-1)[..., None]
+    t_max = np.where(inside, t, -np.inf).argmax(axis=-1)[..., None]
+    ends = np.concatenate([t_min, t_max], axis=-1)
+    segments = np.stack([np.take_along_axis(xs, ends, axis=-1),
+                         np.take_along_axis(ys, ends, axis=-1)], axis=-1)
+    valid = inside.sum(axis=-1) >= 2
+    return np.nan_to_num(segments), valid
+
+
+def _palette(num_colors):
+    hsv = np.stack([np.linspace(0, 180, num_colors, endpoint=False),
+                    np.full(num_colors, 255), np.full(num_colors, 255)], axis=1)
+    return cv2.cvtColor(hsv.astype(np.uint8)[None], cv2.COLOR_HSV2BGR)[0].tolist()
+
+
+def draw_lines_batch(img, lines, pts=None, thickness=1, radius=5, num_colors=16):
+    # 在 img 的副本上一次性绘制所有极线 (M, 3) 和对应点 (M, 2),
+    # 第 i 条直线和第 i 个点同色, 每种颜色只调用一次 cv2.polylines / cv2.fillPoly
+    # lines 为 None 时只画点
+    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR) if img.ndim == 2 else img.copy()
+    h, w = img.shape[:2]
+    if lines is None:
+        lines = np.full((len(pts), 3), np.nan)
+    lines = np.asarray(lines, dtype=np.float64).reshape(-1, 3)
+    segments, valid = clip_lines(lines, w, h)
+    segments = np.round(segments).astype(np.int32)
+    color_ids = np.arange(len(lines)) % num_colors
+    if pts is not None:
+        circle = cv2.ellipse2Poly((0, 0), (radius, radius), 0, 0, 360, 30)
+        pts = np.round(np.asarray(pts, dtype=np.float64).reshape(-1, 2)).astype(np.int32)
+        circles = pts[:, None, :] + circle[None, :, :]
+    for k, color in enumerate(_palette(num_colors)):
+        group = color_ids == k
+        if np.any(group & valid):
+            cv2.polylines(img, segments[group & valid], False, color, thickness)
+        if pts is not None and np.any(group):
+            cv2.fillPoly(img, circles[group], color)
     return img
 
-def find_matches(img1, img2, ratio_threshold=0.7):
+
+def _knn_brute(query, train, k=2, block=1 << 22):
+    # 精确的暴力最近邻: |q - t|^2 = |q|^2 + |t|^2 - 2 q.t, 分块矩阵乘法
+    # 每块距离矩阵最多 block 个元素, 与 train 的大小无关
+    train_sq = np.einsum('ij,ij->i', train, train)
+    idx = np.empty((len(query), k), dtype=np.int64)
+    dist = np.empty((len(query), k), dtype=np.float32)
+    chunk = max(1, block // max(1, len(train)))
+    for start in range(0, len(query), chunk):
+        q = query[start:start + chunk]
+        d = q @ train.T
+        d *= -2
+        d += train_sq[None, :]
+        # 只复制前 k 列, 完整的索引数组立即释放
+        part = np.argpartition(d, k - 1, axis=1)[:, :k].copy()
+        part_d = np.take_along_axis(d, part, axis=1)
+        del d
+        order = np.argsort(part_d, axis=1)
+        idx[start:start + chunk] = np.take_along_axis(part, order, axis=1)
+        part_d = np.take_along_axis(part_d, order, axis=1) + np.einsum('ij,ij->i', q, q)[:, None]
+        dist[start:start + chunk] = np.maximum(part_d, 0)
+    return idx, dist
+
+
+def _knn_flann(query, train, k=2, trees=4, checks=64):
+    # FLANN KD-tree 近似最近邻
+    index = cv2.flann_Index(train, dict(algorithm=1, trees=trees))
+    idx, dist = index.knnSearch(query, k, params=dict(checks=checks))
+    return idx.astype(np.int64), dist
+
+
+MATCHERS = ['bf', 'flann', 'mutual']
+
+
+def match_descriptors(des1, des2, ratio_threshold=0.7, matcher='bf'):
+    # 返回匹配的索引数组 (idx1, idx2), 距离均为 L2 的平方
+    empty = np.zeros(0, dtype=np.int64)
+    if des1 is None or des2 is None or len(des1) < 2 or len(des2) < 2:
+        return empty, empty
+    des1 = np.ascontiguousarray(des1, dtype=np.float32)
+    des2 = np.ascontiguousarray(des2, dtype=np.float32)
+
+    knn = _knn_flann if matcher == 'flann' else _knn_brute
+    idx, dist = knn(des1, des2, 2)
+    keep = np.ones(len(des1), dtype=bool)
+    if ratio_threshold is not None:
+        # ratio test: d0 < r * d1 <=> d0^2 < r^2 * d1^2
+        keep &= dist[:, 0] < ratio_threshold ** 2 * dist[:, 1]
+    if matcher == 'mutual':
+        # 互为最近邻
+        back_idx, _ = _knn_brute(des2, des1, 1)
+        keep &= back_idx[idx[:, 0], 0] == np.arange(len(des1))
+    return np.flatnonzero(keep), idx[keep, 0]
+
+
+SIFT_PARAMS = dict(nfeatures=0, nOctaveLayers=3, contrastThreshold=0.04, edgeThreshold=10, sigma=1.6)
+# 每个关键点: 坐标 + SIFT 描述子 (OpenCV 的 SIFT 描述子是 0-255 的整数, uint8 无损)
+FEATURE_DTYPE = np.dtype([('pt', '<f4', (2,)), ('des', 'u1', (128,))])
+
+
+def _feature_key(img):
+    # 由图像内容和检测参数决定
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((img.shape, img.dtype.str, sorted(SIFT_PARAMS.items()))).encode())
+    h.update(np.ascontiguousarray(img).data)
+    return h.hexdigest()
+
+
+def _save_features(path, feats):
+    # 先写临时文件再 os.replace, 多个进程同时写同一图像也安全
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, feats)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def detect_features(img, cache_dir=None):
+    # 返回关键点坐标 (N, 2) 和描述子 (N, 128)
+    # cache_dir 不为空时, 每张图像的特征保存为一个 .npy 文件并以内存映射读取
+    path = None
+    if cache_dir is not None:
+        key = _feature_key(img)
+        path = os.path.join(cache_dir, key[:2], key + '.npy')
+        if os.path.exists(path):
+            feats = np.load(path, mmap_mode='r')
+            return feats['pt'], feats['des']
+
     # 使用SIFT特征检测和描述子提取
-    sift = cv2.SIFT_create()
+    kp, des = cv2.SIFT_create(**SIFT_PARAMS).detectAndCompute(img, None)
+    feats = np.zeros(len(kp), dtype=FEATURE_DTYPE)
+    if len(kp) > 0:
+        feats['pt'] = cv2.KeyPoint_convert(kp)
+        feats['des'] = des
+    if path is not None:
+        _save_features(path, feats)
+    return feats['pt'], feats['des']
 
-    # 在两个图像中检测关键点和计算描述子
-    kp1, des1 = sift.detectAndCompute(img1, None)
-    kp2, des2 = sift.detectAndCompute(img2, None)
 
-    # 使用BFMatcher进行描述子匹配
-    bf = cv2.BFMatcher(cv2.NORM_L2, crossCheck=False)
-    matches = bf.knnMatch(des1, des2, k=2)
+def find_matches(img1, img2, ratio_threshold=0.7, matcher='bf', cache_dir=None):
+    # 在两个图像中检测关键点和计算描述子
+    pts1, des1 = detect_features(img1, cache_dir)
+    pts2, des2 = detect_features(img2, cache_dir)
 
-    # 通过ratio test筛选出好的匹配
-    good_matches = []
-    for m, n in matches:
-        if m.distance < ratio_threshold * n.distance:
-            good_matches.append(m)
+    # 描述子匹配, matcher: 'bf' 暴力, 'flann' KD-tree, 'mutual' 互为最近邻
+    idx1, idx2 = match_descriptors(des1, des2, ratio_threshold, matcher)
 
     # 获取匹配的点坐标
-    pts1 = np.int32([kp1[m.queryIdx].pt for m in good_matches])
-    pts2 = np.int32([kp2[m.trainIdx].pt for m in good_matches])
+    pts1 = np.int32(pts1[idx1])
+    pts2 = np.int32(pts2[idx2])
 
     return pts1, pts2
 
@@ -71,31 +235,32 @@ def find_matches(img1, img2, ratio_threshold=0.7):
 # cv2.imwrite("/tests/results/epipolar_line/undistorted.jpg", undistorted_result1)
 
 
-undistorted_folder = r"E:\SkdPaper\STAR_Center\result\titan\titan_0_READ_workspace\undistorted_images_0748x1328_0.8"
-file_name_1 = "1693123147400000000_3.jpg"
-file_name_2 = "1693123149800000000_3.jpg"
+if __name__ == "__main__":
+    undistorted_folder = r"E:\SkdPaper\STAR_Center\result\titan\titan_0_READ_workspace\undistorted_images_0748x1328_0.8"
+    file_name_1 = "1693123147400000000_3.jpg"
+    file_name_2 = "1693123149800000000_3.jpg"
 
-file_1 = os.path.join(undistorted_folder, file_name_1)
-file_2 = os.path.join(undistorted_folder, file_name_2)
+    file_1 = os.path.join(undistorted_folder, file_name_1)
+    file_2 = os.path.join(undistorted_folder, file_name_2)
 
-img1 = cv2.imread(file_1, cv2.IMREAD_GRAYSCALE)
-img2 = cv2.imread(file_2, cv2.IMREAD_GRAYSCALE)
+    img1 = cv2.imread(file_1, cv2.IMREAD_GRAYSCALE)
+    img2 = cv2.imread(file_2, cv2.IMREAD_GRAYSCALE)
 
-pts1, pts2 = find_matches(img1, img2)
-print(len(pts1), len(pts2))
-indexes = random.sample(range(0, len(pts1)), 15)
-pts1_sele = []
-pts2_sele = []
-for index in indexes:
-    pts1_sele.append(pts1[index])
-    pts2_sele.append(pts2[index])
-pts1_sele = np.array(pts1_sele)
-pts2_sele = np.array(pts2_sele)
+    pts1, pts2 = find_matches(img1, img2)
+    print(len(pts1), len(pts2))
+    indexes = random.sample(range(0, len(pts1)), 15)
+    pts1_sele = []
+    pts2_sele = []
+    for index in indexes:
+        pts1_sele.append(pts1[index])
+        pts2_sele.append(pts2[index])
+    pts1_sele = np.array(pts1_sele)
+    pts2_sele = np.array(pts2_sele)
 
-print(pts1_sele, pts2_sele)
-F, _ = cv2.findFundamentalMat(pts1_sele, pts2_sele)
-result1, result2 = draw_epilines(img1, img2, pts1_sele, pts2_sele, F)
+    print(pts1_sele, pts2_sele)
+    F, _ = cv2.findFundamentalMat(pts1_sele, pts2_sele)
+    result1, result2 = draw_epilines(img1, img2, pts1_sele, pts2_sele, F)
 
-os.makedirs("./tests/results/epipolar_line/", exist_ok=True)
-cv2.imwrite("./tests/results/epipolar_line/un_res1.jpg", result1)
-cv2.imwrite("./tests/results/epipolar_line/un_res2.jpg", result2)
\ No newline at end of file
+    os.makedirs("./tests/results/epipolar_line/", exist_ok=True)
+    cv2.imwrite("./tests/results/epipolar_line/un_res1.jpg", result1)
+    cv2.imwrite("./tests/results/epipolar_line/un_res2.jpg", result2)
\ No newline at end of file